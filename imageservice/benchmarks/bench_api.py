@@ -0,0 +1,271 @@
+"""
+Benchmark of the upload, list, view and delete APIs.
+The FastAPI app runs in-process against moto's S3 and DynamoDB stand-in, so the numbers
+are reproducible and only measure the service itself (no network, no AWS latency).
+
+Requires moto, httpx and Pillow on top of the service requirements, then
+- PYTHONPATH=src python3 benchmarks/bench_api.py --library small --label baseline
+- PYTHONPATH=src python3 benchmarks/bench_api.py --library small --compare benchmarks/results/baseline.json
+- PYTHONPATH=src python3 benchmarks/bench_api.py --library medium --concurrency 16
+
+Reports per endpoint the throughput, p50/p95/p99 latency, peak RSS and the AWS calls made,
+and saves them as JSON in benchmarks/results. The requests of an endpoint are sent by
+--concurrency clients at once (1 by default, one after the other), and its peak RSS is the
+highest resident memory sampled while they run.
+"""
+import argparse
+import base64
+import collections
+import datetime
+import io
+import json
+import os
+import platform
+import random
+import resource
+import statistics
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# moto refuses to start without credentials, set them before boto3 is imported
+os.environ.setdefault("AWS_ACCESS_KEY_ID", "testing")
+os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "testing")
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+# One user drives every request, the benchmark measures the service and not its rate limits
+os.environ.setdefault("RATE_LIMIT_ENABLED", "0")
+# The post-upload jobs run in the upload request, so their AWS calls are counted against /upload
+# and not the endpoints measured after it, and /list is measured with the thumbnails in place
+os.environ.setdefault("JOB_QUEUE_BACKEND", "inline")
+
+from fastapi.testclient import TestClient
+from moto import mock_aws
+from PIL import Image
+
+from imageservice import cache, clients
+from imageservice.api import app
+from imageservice.utils import DynamoDbWriter, S3Writer
+
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "results")
+USER_ID = "bench-user"
+
+# name: (image count, (width, height))
+LIBRARIES = {
+    "small": (10, (640, 480)),
+    "medium": (100, (1024, 768)),
+    "large": (20, (4000, 3000)),
+}
+
+class AwsCallCounter:
+    """
+    Counts the AWS operations made by the shared clients, eg. s3.GetObject
+    """
+    def __init__(self):
+        self.calls = collections.Counter()
+
+    def __call__(self,event_name:str,**kwargs):
+        self.calls[event_name.split(".",1)[1]] += 1
+
+    def take(self) -> dict:
+        calls = dict(self.calls)
+        self.calls.clear()
+        return calls
+
+def peak_rss_mb() -> float:
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+def rss_mb() -> float:
+    """
+    Current resident memory, the peak of the process where /proc is missing (eg. macOS)
+    """
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / (1024 * 1024)
+    except OSError:
+        return peak_rss_mb()
+
+class RssSampler:
+    """
+    Samples the resident memory in the background, for the peak of one phase instead
+    of the high-water mark of the whole process
+    """
+    def __init__(self,interval:float=0.01):
+        self.interval = interval
+        self.peak = 0.0
+        self.stopped = threading.Event()
+
+    def sample(self):
+        while True:
+            self.peak = max(self.peak, rss_mb())
+            if self.stopped.wait(self.interval):
+                return
+
+    def __enter__(self):
+        self.peak = rss_mb()
+        self.thread = threading.Thread(target=self.sample, daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self,*exc):
+        self.stopped.set()
+        self.thread.join()
+        self.peak = max(self.peak, rss_mb())
+
+def percentile(latencies:list,q:float) -> float:
+    ordered = sorted(latencies)
+    return ordered[min(len(ordered) - 1, int(round(q / 100 * (len(ordered) - 1))))]
+
+def make_image(size:tuple,seed:int) -> bytes:
+    """
+    Noisy JPEG, so the encoded size is close to a real photo of the same dimensions
+    """
+    rng = random.Random(seed)
+    image = Image.frombytes("RGB", size, rng.randbytes(size[0] * size[1] * 3))
+    image_io = io.BytesIO()
+    image.save(image_io, format="JPEG", quality=90)
+    return image_io.getvalue()
+
+def create_storage():
+    S3Writer().client.create_bucket(Bucket=S3Writer().bucket_name)
+    clients.get_dynamodb_resource().create_table(
+        TableName=DynamoDbWriter().tableName,
+        KeySchema=[
+            {"AttributeName": "userId", "KeyType": "HASH"},
+            {"AttributeName": "timestamp", "KeyType": "RANGE"}],
+        AttributeDefinitions=[
+            {"AttributeName": "userId", "AttributeType": "S"},
+            {"AttributeName": "timestamp", "AttributeType": "N"}],
+        BillingMode="PAY_PER_REQUEST")
+
+def measure(name:str,requests:list,counter:AwsCallCounter,cold_cache:bool,concurrency:int=1) -> dict:
+    """
+    Run the requests, each one a function returning the response, concurrency of them at once
+    """
+    def timed(request) -> tuple:
+        if cold_cache:
+            cache.metadata_cache.clear()
+            cache.thumbnail_cache.clear()
+        request_started = time.perf_counter()
+        response = request()
+        return (time.perf_counter() - request_started) * 1000, response.status_code
+
+    counter.take()
+    with RssSampler() as rss:
+        started = time.perf_counter()
+        if concurrency > 1:
+            with ThreadPoolExecutor(max_workers=concurrency) as executor:
+                outcomes = list(executor.map(timed, requests))
+        else:
+            outcomes = [timed(request) for request in requests]
+        elapsed = time.perf_counter() - started
+    latencies = [latency for latency, status_code in outcomes]
+    failures = sum(1 for latency, status_code in outcomes if status_code >= 400)
+    calls = counter.take()
+    return {
+        "endpoint": name,
+        "concurrency": concurrency,
+        "requests": len(requests),
+        "failures": failures,
+        "throughput_rps": len(requests) / elapsed if elapsed else None,
+        "p50_ms": percentile(latencies, 50),
+        "p95_ms": percentile(latencies, 95),
+        "p99_ms": percentile(latencies, 99),
+        "mean_ms": statistics.fmean(latencies),
+        "peak_rss_mb": rss.peak,
+        "aws_calls": calls,
+        "aws_calls_per_request": sum(calls.values()) / len(requests),
+    }
+
+def run_library(client:TestClient,library:str,list_iterations:int,upload_mode:str,counter:AwsCallCounter,cold_cache:bool,
+                concurrency:int=1) -> list:
+    count, size = LIBRARIES[library]
+    userId = f"{USER_ID}-{library}"
+    images = [make_image(size, seed) for seed in range(count)]
+
+    def upload(image:bytes):
+        if upload_mode == "binary":
+            return lambda: client.post("/upload", params={"userId": userId}, content=image,
+                                       headers={"Content-Type": "application/octet-stream"})
+        body = json.dumps(base64.b64encode(image).decode("utf-8"))
+        return lambda: client.post("/upload", params={"userId": userId}, content=body,
+                                   headers={"Content-Type": "application/json"})
+
+    results = [measure("upload", [upload(image) for image in images], counter, cold_cache, concurrency)]
+    timestamps = [item["timestamp"] for item in client.get("/list", params={"userId": userId}).json()["thumbnails"]]
+
+    results.append(measure("list", [lambda: client.get("/list", params={"userId": userId})] * list_iterations,
+                           counter, cold_cache, concurrency))
+    results.append(measure("list_page", [lambda: client.get("/list", params={"userId": userId, "limit": 20})] * list_iterations,
+                           counter, cold_cache, concurrency))
+    results.append(measure("view", [lambda t=t: client.get("/view", params={"userId": userId, "timestamp": t})
+                                    for t in timestamps], counter, cold_cache, concurrency))
+    results.append(measure("view_binary", [lambda t=t: client.get("/view", params={"userId": userId, "timestamp": t, "mode": "binary"})
+                                           for t in timestamps], counter, cold_cache, concurrency))
+    results.append(measure("delete", [lambda t=t: client.post("/delete", params={"userId": userId, "timestamp": t})
+                                      for t in timestamps], counter, cold_cache, concurrency))
+    for result in results:
+        result["library"] = library
+    return results
+
+def compare(results:list,baseline_path:str):
+    with open(baseline_path) as f:
+        baseline = {(r["library"], r["endpoint"], r.get("concurrency", 1)): r for r in json.load(f)["results"]}
+    print(f"\nCompared with {baseline_path}")
+    print(f"{'library':8} {'endpoint':12} {'p50':>9} {'p95':>9} {'rps':>9} {'aws calls':>10}")
+    for result in results:
+        before = baseline.get((result["library"], result["endpoint"], result["concurrency"]))
+        if before is None:
+            continue
+        def change(key:str) -> str:
+            if not before[key]:
+                return "n/a"
+            return f"{(result[key] - before[key]) / before[key] * 100:+.1f}%"
+        print(f"{result['library']:8} {result['endpoint']:12} {change('p50_ms'):>9} {change('p95_ms'):>9} "
+              f"{change('throughput_rps'):>9} {change('aws_calls_per_request'):>10}")
+
+def report(results:list):
+    if results:
+        print(f"{results[0]['concurrency']} concurrent client(s)")
+    print(f"{'library':8} {'endpoint':12} {'rps':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'rss MB':>8} {'aws/req':>8} fail")
+    for r in results:
+        print(f"{r['library']:8} {r['endpoint']:12} {r['throughput_rps']:8.1f} {r['p50_ms']:8.1f} {r['p95_ms']:8.1f} "
+              f"{r['p99_ms']:8.1f} {r['peak_rss_mb']:8.1f} {r['aws_calls_per_request']:8.1f} {r['failures']}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the ImageService API in-process against moto")
+    parser.add_argument("--library", default="small", help=f"Comma separated fixture libraries, of {', '.join(LIBRARIES)}")
+    parser.add_argument("--list-iterations", type=int, default=20, help="Requests made to each /list variant")
+    parser.add_argument("--upload-mode", choices=("base64", "binary"), default="base64")
+    parser.add_argument("--cold-cache", action="store_true", help="Clear the in-process caches before every request")
+    parser.add_argument("--concurrency", type=int, default=1, help="Clients sending the requests of an endpoint at once")
+    parser.add_argument("--label", default=datetime.datetime.now().strftime("%Y%m%d-%H%M%S"), help="Name of the saved results")
+    parser.add_argument("--compare", help="Results file to compare with")
+    args = parser.parse_args()
+
+    with mock_aws():
+        clients.reset()
+        counter = AwsCallCounter()
+        clients.get_session().events.register("before-call", counter)
+        create_storage()
+        with TestClient(app) as client:
+            results = []
+            for library in args.library.split(","):
+                results.extend(run_library(client, library, args.list_iterations, args.upload_mode, counter, args.cold_cache,
+                                           max(args.concurrency, 1)))
+
+    report(results)
+    os.makedirs(RESULTS_DIR, exist_ok=True)
+    path = os.path.join(RESULTS_DIR, f"{args.label}.json")
+    with open(path, "w") as f:
+        json.dump({
+            "label": args.label,
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "args": vars(args),
+            "results": results}, f, indent=2)
+    print(f"\nSaved {path}")
+    if args.compare:
+        compare(results, args.compare)
@@ -0,0 +1,213 @@
+"""
+Async counterparts of the storage layer, used by the FastAPI routes.
+The pooled boto3 clients are thread safe, so every S3/DynamoDB call is awaited on a
+dedicated I/O executor sized like the connection pool, and CPU bound PIL work on a
+separate executor, keeping the event loop free to serve other requests meanwhile.
+"""
+import asyncio
+import concurrent.futures
+import contextvars
+import functools
+import hashlib
+import os
+import tempfile
+import threading
+from collections import Counter
+from imageservice import clients, ratelimit
+from imageservice.imaging import probe_image
+from imageservice.utils import DynamoDbWriter, Metadata, MetadataModel, S3Writer
+
+IO_MAX_WORKERS = int(os.environ.get("IO_MAX_WORKERS", str(clients.AWS_MAX_POOL_CONNECTIONS)))
+CPU_MAX_WORKERS = int(os.environ.get("CPU_MAX_WORKERS", str(os.cpu_count() or 1)))
+
+# S3 refuses parts smaller than 5 MiB, except for the last one
+MIN_PART_SIZE = 5 * 1024 * 1024
+UPLOAD_PART_SIZE = max(int(os.environ.get("UPLOAD_PART_SIZE", str(8 * 1024 * 1024))), MIN_PART_SIZE)
+# Bytes read at most before giving up on recognising the image header
+UPLOAD_PROBE_BYTES = int(os.environ.get("UPLOAD_PROBE_BYTES", str(1024 * 1024)))
+
+_executors = {}
+_executors_lock = threading.Lock()
+
+def get_executor(name:str,max_workers:int) -> concurrent.futures.ThreadPoolExecutor:
+    executor = _executors.get(name)
+    if executor is None:
+        with _executors_lock:
+            if name not in _executors:
+                _executors[name] = concurrent.futures.ThreadPoolExecutor(
+                    max_workers=max_workers,
+                    thread_name_prefix=f"{name}-worker")
+            executor = _executors[name]
+    return executor
+
+async def run_in(executor:concurrent.futures.Executor,func,*args,**kwargs):
+    # The context is copied so request scoped context variables follow the call
+    context = contextvars.copy_context()
+    return await asyncio.get_running_loop().run_in_executor(
+        executor, functools.partial(context.run, func, *args, **kwargs))
+
+async def run_io(func,*args,**kwargs):
+    """
+    Await a blocking AWS call on the I/O executor
+    """
+    return await run_in(get_executor("io",IO_MAX_WORKERS),func,*args,**kwargs)
+
+async def run_cpu(func,*args,**kwargs):
+    """
+    Await CPU bound image work (decode, resize, encode) on the CPU executor
+    """
+    return await run_in(get_executor("cpu",CPU_MAX_WORKERS),func,*args,**kwargs)
+
+# Key: future of the call in progress, see coalesce
+_calls = {}
+coalesce_stats = Counter()
+
+async def coalesce(key,func,*args,**kwargs):
+    """
+    Await func(*args, **kwargs), unless a call with the same key is already in progress,
+    in which case its result is awaited instead of running it again. Only for reads, as
+    the callers share the result object.
+    :parameters
+    -   key : Hashable identifying the result, eg. ("list", userId, etag)
+    A request let in over its concurrency limit only joins, see ratelimit.admit
+    """
+    while key in _calls:
+        future = _calls[key]
+        ratelimit.admit(joining=True)
+        try:
+            result = await asyncio.shield(future)
+            coalesce_stats["coalesced"] += 1
+            return result
+        except asyncio.CancelledError:
+            # The caller running the call went away, this one runs it instead
+            if not future.cancelled():
+                raise
+    ratelimit.admit(joining=False)
+    future = asyncio.get_running_loop().create_future()
+    _calls[key] = future
+    coalesce_stats["calls"] += 1
+    try:
+        result = await func(*args,**kwargs)
+        future.set_result(result)
+        return result
+    except asyncio.CancelledError:
+        future.cancel()
+        raise
+    except Exception as e:
+        future.set_exception(e)
+        # Marks the exception as retrieved when no other caller waited for it
+        future.exception()
+        raise
+    finally:
+        del _calls[key]
+
+def spool_chunk(digest,spool,chunk:bytes):
+    # Hashing and writing a chunk to disk both block, so they run off the event loop
+    digest.update(chunk)
+    spool.write(chunk)
+
+class AsyncProxy:
+    """
+    Exposes every method of the wrapped object as a coroutine awaited on the I/O executor
+    """
+    def __init__(self,target):
+        self.target = target
+
+    def __getattr__(self,name:str):
+        attr = getattr(self.target,name)
+        if not callable(attr):
+            return attr
+        @functools.wraps(attr)
+        async def method(*args,**kwargs):
+            return await run_io(attr,*args,**kwargs)
+        return method
+
+class AsyncS3Writer(AsyncProxy):
+    def __init__(self):
+        super().__init__(S3Writer())
+
+class AsyncDynamoDbWriter(AsyncProxy):
+    def __init__(self):
+        super().__init__(DynamoDbWriter())
+
+class AsyncMetadata(AsyncProxy):
+    def __init__(self,userId:str):
+        super().__init__(Metadata(userId=userId))
+
+    async def write_image_stream(self,chunks,part_size:int=None) -> MetadataModel:
+        """
+        Stream an image to S3 with a multipart upload, holding at most one part in memory.
+        The format and dimensions are probed from the header in the first chunks, and the
+        original is spooled to a temporary file for the thumbnail instead of memory.
+        Returns the existing item when the user already uploaded the same content.
+        Raises ValueError when the content is not a recognised image.
+        :parameters
+        -   chunks : Async iterator of the image bytes, eg. request.stream()
+        -   part_size : Bytes per uploaded part, defaults to UPLOAD_PART_SIZE
+        """
+        part_size = max(part_size or UPLOAD_PART_SIZE, MIN_PART_SIZE)
+        metadata = self.target
+        S3Repo = S3Writer()
+        digest = hashlib.sha256()
+        buffer = bytearray()
+        model = None
+        upload_id = None
+        parts = []
+        probed = 0
+        with tempfile.TemporaryFile() as spool:
+            try:
+                async for chunk in chunks:
+                    await run_cpu(spool_chunk,digest,spool,chunk)
+                    buffer += chunk
+                    if model is None:
+                        # Probed again once the buffer doubled, rather than on every chunk
+                        if len(buffer) < 2 * probed and len(buffer) < UPLOAD_PROBE_BYTES:
+                            continue
+                        probed = len(buffer)
+                        probe = await run_cpu(probe_image,buffer)
+                        if probe is None:
+                            if len(buffer) >= UPLOAD_PROBE_BYTES:
+                                raise ValueError("Unsupported image format")
+                            continue
+                        model = metadata.new_model(format=probe[0],size=probe[1])
+                    while len(buffer) >= part_size:
+                        if upload_id is None:
+                            upload_id = await run_io(S3Repo.create_multipart_upload,model)
+                            if upload_id is None:
+                                raise RuntimeError("Failed to create the multipart upload")
+                        await self.upload_part(S3Repo,model,upload_id,parts,bytes(buffer[:part_size]))
+                        del buffer[:part_size]
+                if model is None and probed < len(buffer):
+                    probe = await run_cpu(probe_image,buffer)
+                    if probe is not None:
+                        model = metadata.new_model(format=probe[0],size=probe[1])
+                if model is None:
+                    raise ValueError("Unsupported image format")
+                model.content_hash = digest.hexdigest()
+                model.byte_size = spool.tell()
+
+                if upload_id is None:
+                    # Smaller than one part, stored (or deduplicated) with a single PUT
+                    existing = await run_io(metadata.store_original,S3Repo,model,bytes(buffer))
+                else:
+                    if buffer:
+                        await self.upload_part(S3Repo,model,upload_id,parts,bytes(buffer))
+                    if not await run_io(S3Repo.complete_multipart_upload,model,upload_id,parts):
+                        raise RuntimeError("Failed to complete the multipart upload")
+                    upload_id = None
+                    # Only known now, the staged upload is moved to its blob or dropped as a duplicate
+                    existing = await run_io(metadata.store_original,S3Repo,model)
+                if existing:
+                    return existing
+                del buffer
+                return await run_io(metadata.commit_image,S3Repo,model,spool)
+            except Exception:
+                if upload_id is not None:
+                    await run_io(S3Repo.abort_multipart_upload,model,upload_id)
+                raise
+
+    async def upload_part(self,S3Repo:S3Writer,model:MetadataModel,upload_id:str,parts:list,body:bytes):
+        part = await run_io(S3Repo.upload_part,model,upload_id,len(parts) + 1,body)
+        if part is None:
+            raise RuntimeError(f"Failed to upload the part {len(parts) + 1}")
+        parts.append(part)
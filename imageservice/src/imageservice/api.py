@@ -1,6 +1,7 @@
 from fastapi import FastAPI
 
-from imageservice.routes import list_images,delete_image,view_image,home,upload_image
+from imageservice import processing, ratelimit, tracing
+from imageservice.routes import list_images,delete_image,view_image,home,upload_image,metrics,jobs
 
 app = FastAPI(
     title= "ImageService API",
@@ -13,9 +14,23 @@ app.include_router(upload_image.router)
 app.include_router(list_images.router)
 app.include_router(delete_image.router)
 app.include_router(view_image.router)
+app.include_router(metrics.router)
+app.include_router(jobs.router)
+
+@app.on_event("shutdown")
+def shutdown():
+    processing.shutdown()
+
+if ratelimit.RATE_LIMIT_ENABLED:
+    app.middleware("http")(ratelimit.middleware)
+
+# Registered last so the trace also covers the rejected requests
+if tracing.TRACING_ENABLED:
+    app.middleware("http")(tracing.middleware)
 
 
 if __name__ == "__main__":
+    # Development server, see imageservice.server for production
     import uvicorn
     uvicorn.run("api:app", host="localhost", port=8000,reload=True)
 
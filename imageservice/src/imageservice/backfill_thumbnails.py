@@ -0,0 +1,30 @@
+"""
+Generate the thumbnail derivatives of images uploaded before thumbnails were stored
+- PYTHONPATH=src python3 -m imageservice.backfill_thumbnails --userId 3241
+- PYTHONPATH=src python3 -m imageservice.backfill_thumbnails --all
+"""
+import argparse
+import logging
+
+from imageservice.utils import DynamoDbWriter, Metadata
+
+logger = logging.getLogger(__name__)
+
+def backfill(userIds:list) -> int:
+    total = 0
+    for userId in userIds:
+        count = Metadata(userId=userId).backfill_thumbnails()
+        logger.info(f"Backfilled {count} thumbnails for user {userId}")
+        total += count
+    return total
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Backfill the thumbnail derivatives of stored images")
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument("--userId", action="append", help="Id of the User to backfill, can be repeated")
+    group.add_argument("--all", action="store_true", help="Backfill every user of the metadata table")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    userIds = DynamoDbWriter().get_user_ids() if args.all else args.userId
+    print(f"Backfilled {backfill(userIds or [])} thumbnails")
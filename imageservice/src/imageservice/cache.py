@@ -0,0 +1,110 @@
+"""
+In-process LRU caches, bounded by the byte size of their values and by a TTL.
+Warm Lambda containers and uvicorn workers serve hot metadata and thumbnails from
+here without an AWS round trip; writes and deletes invalidate the affected keys.
+"""
+import os
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+class LRUCache:
+    """
+    Thread safe LRU cache
+    :parameters
+    -   name : Name reported in the stats
+    -   max_bytes : Total size of the values kept, least recently used ones are evicted first
+    -   ttl : Seconds a value is served before it expires
+    -   sizeof : Function returning the size in bytes of a value
+    """
+    def __init__(self,name:str,max_bytes:int,ttl:float,sizeof=sys.getsizeof):
+        self.name = name
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.sizeof = sizeof
+        self.entries = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+    def get(self,key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            value, size, expires = entry
+            if expires < time.monotonic():
+                self.remove(key)
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self,key,value):
+        size = self.sizeof(value)
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            if key in self.entries:
+                self.remove(key)
+            self.entries[key] = (value, size, time.monotonic() + self.ttl)
+            self.size += size
+            while self.size > self.max_bytes:
+                self.remove(next(iter(self.entries)))
+                self.evictions += 1
+
+    def invalidate(self,key):
+        with self.lock:
+            if key in self.entries:
+                self.remove(key)
+                self.invalidations += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+    def remove(self,key):
+        # Callers hold the lock
+        _, size, _ = self.entries.pop(key)
+        self.size -= size
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "entries": len(self.entries),
+                "bytes": self.size,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "invalidations": self.invalidations,
+            }
+
+def sizeof_model(model) -> int:
+    return sys.getsizeof(model) + len(model.model_dump_json())
+
+metadata_cache = LRUCache(
+    "metadata",
+    max_bytes=int(os.environ.get("METADATA_CACHE_BYTES", str(4 * 1024 * 1024))),
+    ttl=float(os.environ.get("METADATA_CACHE_TTL", "300")),
+    sizeof=sizeof_model)
+
+# Values are the base64 encoded thumbnails, keyed by the S3 key they were read or rendered from
+thumbnail_cache = LRUCache(
+    "thumbnail",
+    max_bytes=int(os.environ.get("THUMBNAIL_CACHE_BYTES", str(64 * 1024 * 1024))),
+    ttl=float(os.environ.get("THUMBNAIL_CACHE_TTL", "3600")),
+    sizeof=len)
+
+def stats() -> dict:
+    return {cache.name: cache.stats() for cache in (metadata_cache, thumbnail_cache)}
@@ -0,0 +1,115 @@
+"""
+Process wide registry of the AWS clients.
+Creating a boto3 client resolves credentials, loads the service model and opens a new
+connection pool, so it is done once per process and reused by every request (and by
+every warm invocation of the Lambda container). boto3 itself is only imported when the
+first client is created, it is the largest part of the import time of the service.
+"""
+import logging
+import os
+import threading
+import time
+from imageservice import tracing
+
+logger = logging.getLogger(__name__)
+
+AWS_MAX_POOL_CONNECTIONS = int(os.environ.get("AWS_MAX_POOL_CONNECTIONS", "50"))
+AWS_MAX_ATTEMPTS = int(os.environ.get("AWS_MAX_ATTEMPTS", "3"))
+AWS_CONNECT_TIMEOUT = float(os.environ.get("AWS_CONNECT_TIMEOUT", "2"))
+AWS_READ_TIMEOUT = float(os.environ.get("AWS_READ_TIMEOUT", "10"))
+
+_lock = threading.RLock()
+_session = None
+_clients = {}
+_local = threading.local()
+# Bumped by reset, so the per thread resources created before are dropped
+_generation = 0
+
+# Seconds spent creating each client/resource, exposed as a startup metric
+init_timings = {}
+
+def get_config():
+    from botocore.config import Config
+    return Config(
+        max_pool_connections=AWS_MAX_POOL_CONNECTIONS,
+        retries={"max_attempts": AWS_MAX_ATTEMPTS, "mode": "standard"},
+        connect_timeout=AWS_CONNECT_TIMEOUT,
+        read_timeout=AWS_READ_TIMEOUT,
+    )
+
+def get_session():
+    global _session
+    with _lock:
+        if _session is None:
+            started = time.perf_counter()
+            import boto3
+            _session = boto3.session.Session()
+            record_timing("session",started)
+        return _session
+
+def record_timing(name:str,started:float):
+    init_timings[name] = time.perf_counter() - started
+    logger.info(f"Created {name} in {init_timings[name] * 1000:.1f} ms")
+
+def error_code(e:Exception) -> str:
+    """
+    AWS error code of a botocore ClientError (eg. NoSuchKey), None for any other exception.
+    Spares the callers importing botocore only to catch its exceptions.
+    """
+    return getattr(e, "response", {}).get("Error", {}).get("Code")
+
+def get_client(service:str):
+    """
+    Shared low level client of a service, boto3 clients are thread safe
+    """
+    client = _clients.get(service)
+    if client is not None:
+        return client
+    with _lock:
+        if service not in _clients:
+            started = time.perf_counter()
+            _clients[service] = get_session().client(service, config=get_config())
+            record_timing(service,started)
+            if tracing.TRACING_ENABLED:
+                tracing.instrument(_clients[service])
+        return _clients[service]
+
+def get_s3_client():
+    return get_client("s3")
+
+def get_dynamodb_resource():
+    """
+    DynamoDB service resource of the calling thread. boto3 resources are not thread safe,
+    so each thread gets its own resource, created once from the shared session.
+    """
+    if getattr(_local, "generation", None) != _generation:
+        with _lock:
+            started = time.perf_counter()
+            _local.dynamodb = get_session().resource("dynamodb", config=get_config())
+            _local.tables = {}
+            _local.generation = _generation
+            if "dynamodb" not in init_timings:
+                record_timing("dynamodb",started)
+            if tracing.TRACING_ENABLED:
+                tracing.instrument(_local.dynamodb.meta.client)
+    return _local.dynamodb
+
+def get_dynamodb_table(table_name:str):
+    """
+    DynamoDB Table of the calling thread
+    """
+    resource = get_dynamodb_resource()
+    if table_name not in _local.tables:
+        _local.tables[table_name] = resource.Table(table_name)
+    return _local.tables[table_name]
+
+def reset():
+    """
+    Drop every client, the next call creates new ones (eg. after changing credentials)
+    """
+    global _session, _generation
+    with _lock:
+        _session = None
+        _generation += 1
+        _clients.clear()
+        init_timings.clear()
@@ -0,0 +1,57 @@
+import hashlib
+import os
+from starlette.responses import Response
+
+# Stored images never change for a given userId/timestamp, a delete makes the url 404.
+# Private, so only the browser of the user keeps them and no shared cache serves them after the delete
+IMMUTABLE_CACHE_CONTROL = os.environ.get("IMMUTABLE_CACHE_CONTROL", "private, max-age=31536000, immutable")
+# Listings change with every upload and delete, clients revalidate them with If-None-Match
+LIST_CACHE_CONTROL = os.environ.get("LIST_CACHE_CONTROL", "private, no-cache")
+
+def list_etag(page) -> str:
+    """
+    Weak ETag of a /list page, derived from the metadata of its items so it is known
+    before any thumbnail is fetched
+    :parameters
+    -   page : ListPageModel of the listing
+    """
+    digest = hashlib.sha256()
+    for item in page.items:
+        digest.update(f"{item.timestamp}|{item.content_hash}|{item.thumbnail}\n".encode("utf-8"))
+    digest.update(str(page.next_cursor).encode("utf-8"))
+    return f'W/"{digest.hexdigest()}"'
+
+def etag_matches(if_none_match:str,etag:str) -> bool:
+    """
+    If-None-Match comparison, uses the weak comparison as required for GET
+    """
+    if not if_none_match or not etag:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    def opaque(tag:str) -> str:
+        tag = tag.strip()
+        return tag[2:] if tag.startswith("W/") else tag
+    return opaque(etag) in [opaque(tag) for tag in if_none_match.split(",")]
+
+def variant_etag(etag:str,name:str) -> str:
+    """
+    ETag of a derivative of an item, from the ETag of the item and the name of the derivative
+    """
+    if not etag:
+        return None
+    return f'{etag[:-1]}-{name}"'
+
+def cache_headers(etag:str,cache_control:str,vary:str=None) -> dict:
+    headers = {"Cache-Control": cache_control}
+    if etag:
+        headers["ETag"] = etag
+    if vary:
+        headers["Vary"] = vary
+    return headers
+
+def not_modified(etag:str,cache_control:str,vary:str=None) -> Response:
+    return Response(
+        status_code=304,
+        headers=cache_headers(etag,cache_control,vary)
+    )
@@ -0,0 +1,220 @@
+"""
+Image processing of the service. PIL is imported on first use, so a cold start which
+does not touch an image (eg. /list served from the caches) does not pay for it.
+"""
+import math
+import os
+from io import BytesIO
+from imageservice.tracing import span
+
+def parse_size(value:str) -> tuple:
+    """
+    Parse a box size, eg. 150 or 200x150
+    """
+    width, _, height = value.lower().partition("x")
+    return int(width), int(height or width)
+
+THUMBNAIL_SIZE = parse_size(os.environ.get("THUMBNAIL_SIZE", "150x150"))
+THUMBNAIL_QUALITY = int(os.environ.get("THUMBNAIL_QUALITY", "75"))
+THUMBNAIL_FORMAT = "JPEG"
+
+# The decoder keeps at least twice the target size, so the final resampling stays sharp
+DRAFT_GAP = 2
+EXIF_ORIENTATION = 0x0112
+# EXIF orientations rotating the image by 90 degrees, which swaps its width and height
+TRANSPOSED_ORIENTATIONS = (5, 6, 7, 8)
+
+def open_image(image):
+    """
+    Open an image lazily, from its content or from a binary file object
+    """
+    from PIL import Image
+    if isinstance(image,(bytes,bytearray)):
+        image = BytesIO(image)
+    image.seek(0)
+    return Image.open(image)
+
+def probe_image(head:bytes) -> tuple:
+    """
+    Read the format and dimensions from the first bytes of an image, only the header is parsed.
+    Returns None when the header is not complete (or not an image).
+    """
+    try:
+        with span("pil.probe"):
+            image = open_image(head)
+        return image.format, image.size
+    except Exception:
+        return None
+
+def stored_box(image,size:tuple) -> tuple:
+    """
+    Box of the image as stored, before its EXIF orientation is applied, for an upright box size
+    """
+    width, height = size
+    if image.getexif().get(EXIF_ORIENTATION) in TRANSPOSED_ORIENTATIONS:
+        return height, width
+    return width, height
+
+def draft(image,size:tuple):
+    """
+    Ask the decoder for a reduced image, before the pixels are loaded. JPEG decodes at 1/2,
+    1/4 or 1/8 of the resolution with DCT scaling, saving most of the CPU and memory of a
+    full decode. Other formats ignore it and are reduced by thumbnail() once decoded.
+    :parameters
+    -   image : Image opened by open_image, not loaded yet
+    -   size : Box the image is resized to afterwards, before the EXIF orientation is applied
+    """
+    width, height = stored_box(image,size)
+    image.draft(None, (width * DRAFT_GAP, height * DRAFT_GAP))
+
+def to_rgb(image,background:tuple=(255, 255, 255)):
+    """
+    Convert an image of any mode to RGB for the JPEG encoder. Transparent areas are laid on
+    the background instead of turning black, 16/32 bit grayscale is scaled down to 8 bit
+    instead of clipping to white.
+    """
+    from PIL import Image
+    if image.mode == "RGB":
+        return image
+    if image.mode.startswith("I"):
+        image = image.convert("I").point(lambda v: v / 256)
+    if image.mode in ("P", "PA", "La", "RGBa") or (image.mode == "L" and "transparency" in image.info):
+        image = image.convert("RGBA")
+    if "A" in image.getbands():
+        flattened = Image.new("RGB", image.size, background)
+        flattened.paste(image.convert("RGBA"), mask=image.getchannel("A"))
+        return flattened
+    return image.convert("RGB")
+
+def make_thumbnail(imagebytes) -> bytes:
+    """
+    Render the thumbnail derivative of an image, upright and in RGB whatever the original
+    :parameters
+    -   imagebytes : Content of the original image, or a binary file object holding it
+    """
+    from PIL import ImageOps
+    with span("pil.open"):
+        thumb = open_image(imagebytes)
+        draft(thumb, THUMBNAIL_SIZE)
+    # Decoding happens lazily, so it is part of the thumbnail stage
+    with span("pil.thumbnail"):
+        # Reduced before it is turned upright, so only the small image is transposed (or copied)
+        thumb.thumbnail(stored_box(thumb, THUMBNAIL_SIZE))
+        thumb = ImageOps.exif_transpose(thumb)
+        thumb = to_rgb(thumb)
+
+    with span("pil.save"):
+        thumb_io = BytesIO()
+        thumb.save(thumb_io, format=THUMBNAIL_FORMAT, quality=THUMBNAIL_QUALITY)
+    return thumb_io.getvalue()
+
+EXIF_IFD = 0x8769
+EXIF_MAKE = 0x010F
+EXIF_MODEL = 0x0110
+EXIF_DATETIME = 0x0132
+EXIF_DATETIME_ORIGINAL = 0x9003
+
+def read_exif(head:bytes) -> dict:
+    """
+    Read the capture date and camera of an image from its first bytes, the EXIF block
+    sits in the header. Missing tags are left out.
+    """
+    with span("pil.exif"):
+        exif = open_image(head).getexif()
+    info = {}
+    taken_at = exif.get_ifd(EXIF_IFD).get(EXIF_DATETIME_ORIGINAL) or exif.get(EXIF_DATETIME)
+    if taken_at:
+        # EXIF dates are local times written as 2024:05:01 10:00:00
+        info["taken_at"] = str(taken_at).strip("\x00 ").replace(":", "-", 2)
+    camera = " ".join(str(exif.get(tag)).strip("\x00 ") for tag in (EXIF_MAKE, EXIF_MODEL) if exif.get(tag))
+    if camera:
+        info["camera"] = camera
+    return info
+
+# Variant formats served by /view, by the name used in the API
+VARIANT_FORMATS = {"jpeg": "JPEG", "png": "PNG", "webp": "WEBP", "avif": "AVIF"}
+VARIANT_FITS = ("contain", "cover", "fill")
+
+def supports_format(format:str) -> bool:
+    """
+    Whether the installed PIL can encode the format, AVIF depends on the build
+    """
+    from PIL import Image
+    Image.init()
+    return VARIANT_FORMATS.get(format) in Image.SAVE
+
+def render_variant(imagebytes,width:int=None,height:int=None,fit:str="contain",format:str="jpeg",quality:int=85) -> bytes:
+    """
+    Render a resized/converted variant of an image, never larger than the original
+    :parameters
+    -   imagebytes : Content of the original image, or a binary file object holding it
+    -   width, height : Bounding box of the variant, the missing one follows the aspect ratio
+    -   fit : contain (fit in the box), cover (fill the box, cropping the overflow) or fill (stretch to the box)
+    -   format : One of VARIANT_FORMATS
+    -   quality : Encoder quality, 1 to 100
+    """
+    from PIL import ImageOps
+    with span("pil.open"):
+        image = open_image(imagebytes)
+        # Upright size from the header, nothing is decoded yet
+        upright_width, upright_height = stored_box(image, image.size)
+        boxed = bool(width and height)
+        if width and not height:
+            height = max(round(upright_height * width / upright_width), 1)
+        elif height and not width:
+            width = max(round(upright_width * height / upright_height), 1)
+        box = (min(width or upright_width, upright_width), min(height or upright_height, upright_height))
+        draft(image, box)
+    with span("pil.resize"):
+        # Resized against the box as stored before it is turned upright, so only the
+        # small image is transposed, the crop of cover being centered it is the same
+        if fit == "cover" and boxed:
+            image = ImageOps.fit(image, stored_box(image, box))
+        elif fit == "fill" and boxed:
+            image = image.resize(stored_box(image, box))
+        else:
+            image.thumbnail(stored_box(image, box))
+        image = ImageOps.exif_transpose(image)
+
+    pil_format = VARIANT_FORMATS[format]
+    if pil_format == "JPEG":
+        image = to_rgb(image)
+    elif image.mode not in ("RGB", "RGBA", "L", "LA"):
+        image = image.convert("RGBA" if "A" in image.getbands() or "transparency" in image.info else "RGB")
+
+    with span("pil.save"):
+        image_io = BytesIO()
+        image.save(image_io, format=pil_format, quality=quality)
+    return image_io.getvalue()
+
+SPRITE_FORMATS = ("jpeg", "webp", "png")
+
+def make_sprite(tiles:list,format:str="jpeg",quality:int=80) -> tuple:
+    """
+    Compose thumbnails into one sprite image, laid out on a square-ish grid of cells
+    as large as the largest thumbnail
+    :parameters
+    -   tiles : Content of the thumbnails
+    -   format : One of SPRITE_FORMATS
+    Returns the content of the sprite and the (x, y, width, height) box of every tile
+    """
+    from PIL import Image
+    with span("pil.open"):
+        images = [open_image(tile) for tile in tiles]
+    if not images:
+        return None, []
+    cell_width = max(image.width for image in images)
+    cell_height = max(image.height for image in images)
+    columns = math.ceil(math.sqrt(len(images)))
+    rows = math.ceil(len(images) / columns)
+    with span("pil.sprite"):
+        sprite = Image.new("RGB", (columns * cell_width, rows * cell_height), (255, 255, 255))
+        boxes = []
+        for index, image in enumerate(images):
+            x, y = index % columns * cell_width, index // columns * cell_height
+            sprite.paste(to_rgb(image), (x, y))
+            boxes.append((x, y, image.width, image.height))
+    with span("pil.save"):
+        sprite_io = BytesIO()
+        sprite.save(sprite_io, format=VARIANT_FORMATS[format], quality=quality)
+    return sprite_io.getvalue(), boxes
@@ -0,0 +1,347 @@
+"""
+Post-upload processing, run in the background so /upload returns once the original
+and its metadata are stored. Every upload enqueues the manifest job (when manifests are
+enabled) and one job per kind in UPLOAD_JOBS (thumbnail, enrich, variants), each retried
+up to JOB_MAX_ATTEMPTS times.
+The job status of an image is kept by the queue store and served by /jobs.
+
+JOB_QUEUE_BACKEND selects the store and the way the jobs run
+-   memory : in-process queue and worker pool, jobs are lost with the process (default)
+-   sqlite : same worker pool, jobs are kept in a SQLite file and resumed on restart.
+             Every job is leased by the process running it for JOB_LEASE seconds, renewed
+             while it runs, so the workers sharing the file only take over the jobs of a
+             process that stopped
+-   inline : jobs run in the request, for runtimes freezing the process between
+             requests such as Lambda
+"""
+import concurrent.futures
+import datetime
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+import traceback
+import typing
+import uuid
+from collections import Counter, OrderedDict
+from decimal import Decimal
+from pydantic import BaseModel
+
+logger = logging.getLogger(__name__)
+
+JOB_QUEUE_BACKEND = os.environ.get("JOB_QUEUE_BACKEND", "memory").lower()
+JOB_QUEUE_PATH = os.environ.get("JOB_QUEUE_PATH", "/tmp/imageservice-jobs.sqlite3")
+JOB_WORKERS = int(os.environ.get("JOB_WORKERS", "4"))
+JOB_MAX_ATTEMPTS = int(os.environ.get("JOB_MAX_ATTEMPTS", "3"))
+# Seconds a job stays leased by its process without a renewal, after which another process takes it over
+JOB_LEASE = int(os.environ.get("JOB_LEASE", "60"))
+# Finished jobs kept for the status queries
+JOB_HISTORY = int(os.environ.get("JOB_HISTORY", "10000"))
+UPLOAD_JOBS = [kind.strip() for kind in os.environ.get("UPLOAD_JOBS", "thumbnail,enrich,variants").split(",") if kind.strip()]
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+class JobModel(BaseModel):
+    id : str
+    kind : str
+    userId : str
+    timestamp : Decimal
+    status : str = QUEUED
+    attempts : int = 0
+    error : typing.Optional[str] = None
+    created : typing.Optional[str] = None
+    updated : typing.Optional[str] = None
+
+def now() -> str:
+    return datetime.datetime.now(datetime.timezone.utc).isoformat()
+
+# Job kind: function(userId, timestamp, imagesource) doing the work, raising on failure
+handlers = {}
+
+def handler(kind:str):
+    """
+    Register the function running the jobs of a kind
+    """
+    def register(func):
+        handlers[kind] = func
+        return func
+    return register
+
+@handler("manifest")
+def manifest_job(userId:str,timestamp:Decimal,imagesource=None):
+    from imageservice.utils import Metadata
+    Metadata(userId=userId).sync_manifest(timestamp,imagesource)
+
+@handler("thumbnail")
+def thumbnail_job(userId:str,timestamp:Decimal,imagesource=None):
+    from imageservice.utils import Metadata
+    Metadata(userId=userId).process_thumbnail(timestamp,imagesource)
+
+@handler("enrich")
+def enrich_job(userId:str,timestamp:Decimal,imagesource=None):
+    from imageservice.utils import Metadata
+    Metadata(userId=userId).enrich_item(timestamp,imagesource)
+
+@handler("variants")
+def variants_job(userId:str,timestamp:Decimal,imagesource=None):
+    from imageservice.utils import Metadata
+    Metadata(userId=userId).render_upload_variants(timestamp,imagesource)
+
+class MemoryJobStore:
+    """
+    Jobs kept in the process, the oldest finished ones are dropped past JOB_HISTORY
+    """
+    def __init__(self,history:int=JOB_HISTORY):
+        self.history = history
+        self.jobs = OrderedDict()
+        self.lock = threading.Lock()
+
+    def add(self,job:JobModel):
+        with self.lock:
+            self.jobs[job.id] = job
+            if len(self.jobs) > self.history:
+                finished = [job_id for job_id, job in self.jobs.items() if job.status in (DONE, FAILED)]
+                for job_id in finished[:len(self.jobs) - self.history]:
+                    del self.jobs[job_id]
+
+    def update(self,job:JobModel):
+        job.updated = now()
+        with self.lock:
+            self.jobs[job.id] = job
+
+    def get_for_item(self,userId:str,timestamp:Decimal) -> list:
+        with self.lock:
+            return [job.model_copy() for job in self.jobs.values()
+                    if job.userId == userId and job.timestamp == Decimal(str(timestamp))]
+
+    def renew(self) -> int:
+        return 0
+
+    def take_over(self) -> list:
+        return []
+
+    def counts(self) -> dict:
+        with self.lock:
+            return dict(Counter(job.status for job in self.jobs.values()))
+
+class SqliteJobStore:
+    """
+    Jobs kept in a SQLite file, so the ones queued or running when the process stopped
+    are resumed by the next one
+    :parameters
+    -   owner : Process leasing the jobs it adds or takes over
+    -   lease : Seconds a job stays leased without a renewal
+    """
+    def __init__(self,path:str=JOB_QUEUE_PATH,history:int=JOB_HISTORY,owner:str=None,lease:int=JOB_LEASE):
+        self.path = path
+        self.history = history
+        self.owner = owner or f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self.lease = lease
+        with self.connect() as db:
+            db.execute("""CREATE TABLE IF NOT EXISTS jobs (
+                id TEXT PRIMARY KEY, kind TEXT, userId TEXT, timestamp TEXT, status TEXT,
+                attempts INTEGER, error TEXT, created TEXT, updated TEXT, owner TEXT, lease REAL)""")
+            # Files created before the leases
+            columns = [row[1] for row in db.execute("PRAGMA table_info(jobs)").fetchall()]
+            for column, kind in (("owner", "TEXT"), ("lease", "REAL")):
+                if column not in columns:
+                    db.execute(f"ALTER TABLE jobs ADD COLUMN {column} {kind}")
+            db.execute("CREATE INDEX IF NOT EXISTS jobs_item ON jobs (userId, timestamp)")
+            db.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, updated)")
+
+    def connect(self) -> sqlite3.Connection:
+        # One connection per call, sqlite3 connections cannot be shared between threads
+        return sqlite3.connect(self.path, timeout=30)
+
+    def to_job(self,row:tuple) -> JobModel:
+        return JobModel(id=row[0], kind=row[1], userId=row[2], timestamp=Decimal(row[3]), status=row[4],
+                        attempts=row[5], error=row[6], created=row[7], updated=row[8])
+
+    def add(self,job:JobModel):
+        with self.connect() as db:
+            db.execute("INSERT INTO jobs VALUES (?,?,?,?,?,?,?,?,?,?,?)",
+                       (job.id, job.kind, job.userId, str(job.timestamp), job.status,
+                        job.attempts, job.error, job.created, job.updated, self.owner, time.time() + self.lease))
+            db.execute("""DELETE FROM jobs WHERE id IN (
+                SELECT id FROM jobs WHERE status IN (?,?) ORDER BY updated DESC LIMIT -1 OFFSET ?)""",
+                       (DONE, FAILED, self.history))
+
+    def update(self,job:JobModel):
+        job.updated = now()
+        with self.connect() as db:
+            # A job taken over by another process is left to it
+            db.execute("UPDATE jobs SET status=?, attempts=?, error=?, updated=?, lease=? WHERE id=? AND owner=?",
+                       (job.status, job.attempts, job.error, job.updated, time.time() + self.lease, job.id, self.owner))
+
+    def get_for_item(self,userId:str,timestamp:Decimal) -> list:
+        with self.connect() as db:
+            rows = db.execute("SELECT * FROM jobs WHERE userId=? AND timestamp=? ORDER BY created",
+                              (userId, str(Decimal(str(timestamp))))).fetchall()
+        return [self.to_job(row) for row in rows]
+
+    def renew(self) -> int:
+        """
+        Extend the lease of the jobs of this process still queued or running
+        """
+        with self.connect() as db:
+            return db.execute("UPDATE jobs SET lease=? WHERE owner=? AND status IN (?,?)",
+                              (time.time() + self.lease, self.owner, QUEUED, RUNNING)).rowcount
+
+    def take_over(self) -> list:
+        """
+        Lease to this process the jobs queued or running whose lease expired, ie. left
+        by a process that stopped, or added before the leases
+        """
+        with self.connect() as db:
+            db.execute("BEGIN IMMEDIATE")
+            rows = db.execute("SELECT * FROM jobs WHERE status IN (?,?) AND (lease IS NULL OR lease < ?) ORDER BY created",
+                              (QUEUED, RUNNING, time.time())).fetchall()
+            db.executemany("UPDATE jobs SET owner=?, lease=? WHERE id=?",
+                           [(self.owner, time.time() + self.lease, row[0]) for row in rows])
+        return [self.to_job(row) for row in rows]
+
+    def counts(self) -> dict:
+        with self.connect() as db:
+            return dict(db.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall())
+
+class JobQueue:
+    """
+    Runs the jobs on a worker pool, recording their status in the store
+    """
+    def __init__(self,store,workers:int=JOB_WORKERS,max_attempts:int=JOB_MAX_ATTEMPTS):
+        self.store = store
+        self.max_attempts = max_attempts
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix="job-worker")
+        self.lock = threading.Lock()
+        self.in_flight = 0
+
+    def enqueue(self,userId:str,timestamp:Decimal,kinds:list=None,imagesource=None) -> list:
+        """
+        Queue the post-upload jobs of an image
+        :parameters
+        -   kinds : Job kinds to run, defaults to UPLOAD_JOBS
+        -   imagesource : Content of the original when at hand, only used by the inline queue,
+                          the background jobs read it back from S3
+        """
+        jobs = []
+        for kind in UPLOAD_JOBS if kinds is None else kinds:
+            if kind not in handlers:
+                logger.error(f"Unknown job kind {kind}")
+                continue
+            job = JobModel(id=uuid.uuid4().hex, kind=kind, userId=userId, timestamp=timestamp,
+                           created=now(), updated=now())
+            self.store.add(job)
+            self.submit(job,imagesource)
+            jobs.append(job)
+        return jobs
+
+    def submit(self,job:JobModel,imagesource=None):
+        with self.lock:
+            self.in_flight += 1
+        self.executor.submit(self.run,job)
+
+    def run(self,job:JobModel,imagesource=None):
+        try:
+            while job.attempts < self.max_attempts:
+                job.attempts += 1
+                job.status = RUNNING
+                self.store.update(job)
+                try:
+                    handlers[job.kind](job.userId,job.timestamp,imagesource)
+                    job.status = DONE
+                    job.error = None
+                    self.store.update(job)
+                    return
+                except Exception as e:
+                    job.error = str(e) or type(e).__name__
+                    logger.error(f"Job {job.kind} of {job.userId}/{job.timestamp} failed, attempt {job.attempts}, "
+                                 f"Reason {traceback.format_exc(chain=False)}")
+                    if job.attempts < self.max_attempts:
+                        time.sleep(0.5 * 2 ** (job.attempts - 1))
+            job.status = FAILED
+            self.store.update(job)
+        finally:
+            with self.lock:
+                self.in_flight -= 1
+
+    def resume(self) -> int:
+        """
+        Queue again the jobs left queued or running by a process that stopped.
+        The jobs are idempotent, so one interrupted half way only redoes its work.
+        """
+        jobs = self.store.take_over()
+        for job in jobs:
+            self.submit(job)
+        return len(jobs)
+
+    def keep_leases(self,interval:float):
+        """
+        Renew the leases of the jobs of this process and take over the expired ones every interval seconds
+        """
+        def loop():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.store.renew()
+                    resumed = self.resume()
+                    if resumed:
+                        logger.info(f"Resumed {resumed} jobs from {JOB_QUEUE_PATH}")
+                except:
+                    logger.error(f"Failed to renew the job leases {traceback.format_exc(chain=False)}")
+        threading.Thread(target=loop, name="job-leases", daemon=True).start()
+
+    def get_jobs(self,userId:str,timestamp:Decimal) -> list:
+        return self.store.get_for_item(userId,timestamp)
+
+    def stats(self) -> dict:
+        return {
+            "backend": JOB_QUEUE_BACKEND,
+            "in_flight": self.in_flight,
+            "statuses": self.store.counts()
+        }
+
+class InlineJobQueue(JobQueue):
+    """
+    Runs the jobs in the calling thread before enqueue returns
+    """
+    def __init__(self,store,max_attempts:int=JOB_MAX_ATTEMPTS):
+        self.store = store
+        self.max_attempts = max_attempts
+        self.lock = threading.Lock()
+        self.in_flight = 0
+
+    def submit(self,job:JobModel,imagesource=None):
+        with self.lock:
+            self.in_flight += 1
+        self.run(job,imagesource)
+
+_queue = None
+_queue_lock = threading.Lock()
+
+def get_queue() -> JobQueue:
+    """
+    Job queue of the process, created on first use
+    """
+    global _queue
+    if _queue is None:
+        with _queue_lock:
+            if _queue is None:
+                if JOB_QUEUE_BACKEND == "sqlite":
+                    _queue = JobQueue(SqliteJobStore())
+                    resumed = _queue.resume()
+                    if resumed:
+                        logger.info(f"Resumed {resumed} jobs from {JOB_QUEUE_PATH}")
+                    _queue.keep_leases(JOB_LEASE / 3)
+                elif JOB_QUEUE_BACKEND == "inline":
+                    _queue = InlineJobQueue(MemoryJobStore())
+                else:
+                    _queue = JobQueue(MemoryJobStore())
+    return _queue
+
+def enqueue(userId:str,timestamp:Decimal,kinds:list=None,imagesource=None) -> list:
+    return get_queue().enqueue(userId,timestamp,kinds,imagesource)
@@ -1,10 +1,20 @@
 import os
-from mangum import Mangum
-from imageservice.api import app
+# The container is frozen between invocations, so the post-upload jobs run in the request
+os.environ.setdefault("JOB_QUEUE_BACKEND", "inline")
+from imageservice import startup
+
+with startup.measure("import"):
+    from mangum import Mangum
+    from imageservice.api import app
+
+# Created during the init phase, reused by every warm invocation of the container
+if startup.WARMUP_ENABLED:
+    with startup.measure("warm_up"):
+        startup.warm_up()
 
 lambda_handler = Mangum(
     app,
     lifespan="off",
     api_gateway_base_path=os.environ.get("API_GATEWAY_BASE_PATH")
 ) 
-
+startup.report()
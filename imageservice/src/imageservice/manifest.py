@@ -0,0 +1,262 @@
+"""
+Compact index of the image library of a user, so /list reads the metadata of every
+item with a single S3 GET instead of paginated DynamoDB queries.
+
+The manifest is stored at <userId>/manifest.bin, a header followed by one packed
+record (width, height, byte size, raw SHA-256 of the content, flags) per item in
+ascending timestamp order, then the strings of the items (timestamp, format) separated
+by NUL bytes. The blob and thumbnail keys are not stored, the flags tell whether the
+item has them and they are derived from the hash like S3Writer does.
+Items are decoded without model validation.
+
+DynamoDB stays the source of truth. The manifest job of an upload, the thumbnail job and
+the deletes update the manifest with conditional PUTs (If-Match on its ETag), and a
+missing or dirty manifest is rebuilt from DynamoDB by the next /list. Every update
+changes the ETag, so a rebuild racing with an update is discarded instead of overwriting
+it. The updates of a user made at once in a process are applied by a single GET and PUT.
+"""
+import bisect
+import logging
+import os
+import struct
+import threading
+import traceback
+import uuid
+from decimal import Decimal
+from imageservice import clients, utils
+from imageservice.tracing import span
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_ENABLED = os.environ.get("MANIFEST_ENABLED", "1").lower() in ("1", "true", "yes")
+MANIFEST_ATTEMPTS = int(os.environ.get("MANIFEST_ATTEMPTS", "5"))
+
+MAGIC = b"IMFT"
+VERSION = 2
+DIRTY = 1
+# magic, version, flags, item count
+HEADER = struct.Struct("<4sBBI")
+# width, height, byte size, content hash, flags
+RECORD = struct.Struct("<IIQ32sB")
+FIELDS = 2
+# Flags of a record
+HAS_HASH = 1
+HAS_THUMBNAIL = 2
+HAS_BLOB = 4
+
+def encode(items:list) -> bytes:
+    records = b"".join(
+        RECORD.pack(int(item.size[0]), int(item.size[1]), item.byte_size or 0,
+                    bytes.fromhex(item.content_hash) if item.content_hash else b"",
+                    (HAS_HASH if item.content_hash else 0) | (HAS_THUMBNAIL if item.thumbnail else 0)
+                    | (HAS_BLOB if item.blob else 0))
+        for item in items)
+    strings = "\0".join(f"{item.timestamp}\0{item.format}" for item in items)
+    return HEADER.pack(MAGIC, VERSION, 0, len(items)) + records + strings.encode("utf-8")
+
+def dirty_marker() -> bytes:
+    # The nonce gives every marker a new ETag
+    return HEADER.pack(MAGIC, VERSION, DIRTY, 0) + uuid.uuid4().bytes
+
+def decode(userId:str,body:bytes,S3Repo:utils.S3Writer=None) -> list:
+    """
+    Items of a manifest, None when it is dirty or not readable
+    :parameters
+    -   S3Repo : Writer deriving the blob and thumbnail keys
+    """
+    if len(body) < HEADER.size:
+        return None
+    magic, version, flags, count = HEADER.unpack_from(body)
+    if magic != MAGIC or version != VERSION or flags & DIRTY:
+        return None
+    end = HEADER.size + RECORD.size * count
+    strings = body[end:].decode("utf-8").split("\0")
+    S3Repo = S3Repo or utils.S3Writer()
+    construct = utils.MetadaDataResponseModel.model_construct
+    items = []
+    for index, (width, height, byte_size, digest, flags) in enumerate(RECORD.iter_unpack(body[HEADER.size:end])):
+        timestamp, format = strings[index * FIELDS:(index + 1) * FIELDS]
+        content_hash = digest.hex() if flags & HAS_HASH else None
+        item = construct(
+            userId=userId,
+            timestamp=Decimal(timestamp),
+            format=format,
+            size=(width, height),
+            byte_size=byte_size or None,
+            thumbnail=None,
+            content_hash=content_hash,
+            blob=S3Repo.get_blob_path(content_hash,format) if flags & HAS_BLOB else None)
+        if flags & HAS_THUMBNAIL:
+            item.thumbnail = S3Repo.get_thumbnail_path_from_metadata(itemInfo=item)
+        items.append(item)
+    return items
+
+def page(items:list,userId:str,limit:int=None,cursor:str=None,newest_first:bool=False) -> utils.ListPageModel:
+    """
+    One page of the items of a manifest, with the same cursors as the DynamoDB pages
+    """
+    timestamps = [item.timestamp for item in items]
+    if newest_first:
+        end = bisect.bisect_left(timestamps, utils.decode_cursor(cursor,userId)["timestamp"]) if cursor else len(items)
+        start = max(end - limit, 0) if limit else 0
+        selected = items[start:end][::-1]
+        more = start > 0
+    else:
+        start = bisect.bisect_right(timestamps, utils.decode_cursor(cursor,userId)["timestamp"]) if cursor else 0
+        end = start + limit if limit else len(items)
+        selected = items[start:end]
+        more = end < len(items)
+    return utils.ListPageModel.model_construct(
+        items=selected,
+        next_cursor=utils.encode_cursor({"timestamp": selected[-1].timestamp}) if more and selected else None)
+
+class Batch:
+    """
+    Changes to the manifest of a user applied together, see Manifest.update
+    """
+    def __init__(self):
+        self.changes = []
+        self.done = threading.Event()
+        self.result = False
+
+# userId: batch collecting the changes not applied yet
+_batches = {}
+_batches_lock = threading.Lock()
+# One update of a user at a time per process, users are spread over the locks
+_update_locks = [threading.Lock() for _ in range(64)]
+
+class Manifest:
+    def __init__(self,userId:str,S3Repo:utils.S3Writer=None):
+        self.userId = userId
+        self.S3Repo = S3Repo or utils.S3Writer()
+        self.key = f"{userId}/manifest.bin"
+
+    def get(self) -> tuple:
+        """
+        Body and ETag of the stored manifest, (None, None) when there is none
+        """
+        try:
+            response = self.S3Repo.client.get_object(Bucket=self.S3Repo.bucket_name, Key=self.key)
+            return response["Body"].read(), response["ETag"]
+        except Exception as e:
+            if clients.error_code(e) in ("NoSuchKey","404"):
+                return None, None
+            raise
+
+    def put(self,body:bytes,etag:str=None,unconditional:bool=False) -> bool:
+        """
+        Store the manifest if it was not changed since it was read with etag (or still does
+        not exist when etag is None), returns False when it was
+        """
+        kwargs = {}
+        if not unconditional:
+            kwargs = {"IfMatch": etag} if etag else {"IfNoneMatch": "*"}
+        try:
+            self.S3Repo.client.put_object(Bucket=self.S3Repo.bucket_name, Key=self.key, Body=body,
+                                          ContentType="application/octet-stream", **kwargs)
+            return True
+        except Exception as e:
+            # 409 when a concurrent conditional write is in progress
+            if clients.error_code(e) in ("PreconditionFailed","ConditionalRequestConflict","NoSuchKey","412","409","404"):
+                return False
+            raise
+
+    def read(self) -> list:
+        """
+        Every item of the user in ascending timestamp order, rebuilt from DynamoDB when the
+        manifest is missing or dirty. Returns None when the items could not be read.
+        """
+        with span("manifest.read"):
+            try:
+                body, etag = self.get()
+            except:
+                logger.error(f"Failed to read the manifest of {self.userId} {traceback.format_exc(chain=False)}")
+                return utils.DynamoDbWriter().get_meta_items(userId=self.userId)
+            items = decode(self.userId,body,self.S3Repo) if body is not None else None
+        if items is not None:
+            return items
+        with span("manifest.rebuild"):
+            items = utils.DynamoDbWriter().get_meta_items(userId=self.userId)
+            if items:
+                # Lost when an update went first, the next read rebuilds again
+                self.put(encode(items),etag)
+        return items
+
+    def update(self,mutate) -> bool:
+        """
+        Apply a change to the stored manifest. The changes made while another update of the
+        user is in progress in this process wait for it, then are applied by one update.
+        :parameters
+        -   mutate : Function returning the new list of items from the current one
+        """
+        with _batches_lock:
+            batch = _batches.get(self.userId)
+            leader = batch is None
+            if leader:
+                batch = _batches[self.userId] = Batch()
+            batch.changes.append(mutate)
+        if not leader:
+            batch.done.wait()
+            return batch.result
+        def mutate_all(items:list) -> list:
+            for change in batch.changes:
+                items = change(items)
+            return items
+        with _update_locks[hash(self.userId) % len(_update_locks)]:
+            try:
+                # Closed once the previous update is done, the next changes start a new batch
+                with _batches_lock:
+                    del _batches[self.userId]
+                batch.result = self.apply(mutate_all)
+            finally:
+                batch.done.set()
+        return batch.result
+
+    def apply(self,mutate) -> bool:
+        """
+        Apply a change to the stored manifest, retried when it changed concurrently.
+        A missing or dirty manifest is marked dirty again, so a rebuild in progress
+        without this change is discarded.
+        :parameters
+        -   mutate : Function returning the new list of items from the current one
+        """
+        try:
+            for attempt in range(MANIFEST_ATTEMPTS):
+                body, etag = self.get()
+                items = decode(self.userId,body,self.S3Repo) if body is not None else None
+                new_body = encode(mutate(items)) if items is not None else dirty_marker()
+                if self.put(new_body,etag):
+                    return True
+            logger.error(f"Manifest of {self.userId} kept changing, marked dirty")
+            return self.put(dirty_marker(),unconditional=True)
+        except:
+            logger.error(f"Failed to update the manifest of {self.userId} {traceback.format_exc(chain=False)}")
+            try:
+                return self.put(dirty_marker(),unconditional=True)
+            except:
+                return False
+
+    def sync(self,timestamp:Decimal,item) -> bool:
+        """
+        Add, replace or remove the item of a timestamp as read from DynamoDB, [] when it is deleted
+        """
+        return self.add(item) if item else self.remove([timestamp])
+
+    def add(self,item) -> bool:
+        def mutate(items:list) -> list:
+            items = [existing for existing in items if existing.timestamp != item.timestamp]
+            items.insert(bisect.bisect([existing.timestamp for existing in items], item.timestamp), item)
+            return items
+        return self.update(mutate)
+
+    def remove(self,timestamps:list) -> bool:
+        removed = {Decimal(str(timestamp)) for timestamp in timestamps}
+        return self.update(lambda items: [item for item in items if item.timestamp not in removed])
+
+    def set_thumbnail(self,timestamp:Decimal,thumbnail:str) -> bool:
+        def mutate(items:list) -> list:
+            for item in items:
+                if item.timestamp == timestamp:
+                    item.thumbnail = thumbnail
+            return items
+        return self.update(mutate)
@@ -0,0 +1,161 @@
+"""
+Pool running the CPU bound image work (thumbnails, EXIF, variants, sprites) off the
+threads serving requests.
+
+IMAGE_POOL selects where the work runs
+-   thread : on a thread pool of the process (default), PIL releases the GIL while it
+             decodes and encodes but the rest of the work still contends for it
+-   process : on a pool of worker processes, used by the multi-worker server so one
+              container uses all its cores on image heavy traffic
+
+At most IMAGE_QUEUE_LIMIT tasks are queued or running at once. A caller waits up to
+IMAGE_QUEUE_TIMEOUT seconds for a slot, then gets Overloaded, which the routes answer
+with 503 and the background jobs retry.
+"""
+import concurrent.futures
+import contextvars
+import functools
+import multiprocessing
+import os
+import threading
+import time
+from imageservice.tracing import span
+
+IMAGE_POOL = os.environ.get("IMAGE_POOL", "thread").lower()
+IMAGE_WORKERS = int(os.environ.get("IMAGE_WORKERS", str(os.cpu_count() or 1)))
+IMAGE_QUEUE_LIMIT = int(os.environ.get("IMAGE_QUEUE_LIMIT", str(IMAGE_WORKERS * 4)))
+IMAGE_QUEUE_TIMEOUT = float(os.environ.get("IMAGE_QUEUE_TIMEOUT", "10"))
+
+class Overloaded(RuntimeError):
+    """
+    No slot of the image pool freed up in time
+    """
+
+def init_worker():
+    # Loads the PIL plugins once per worker process instead of on its first task
+    from PIL import Image
+    Image.init()
+
+def portable(arg):
+    # Files cannot be sent to a worker process, their content is
+    if hasattr(arg,"read"):
+        arg.seek(0)
+        return arg.read()
+    return arg
+
+class ImagePool:
+    """
+    Bounded executor of image work, counting the tasks for /metrics
+    :parameters
+    -   backend : thread or process
+    -   workers : Threads or processes running the tasks
+    -   queue_limit : Tasks queued or running at once, at least workers
+    """
+    def __init__(self,backend:str=IMAGE_POOL,workers:int=IMAGE_WORKERS,queue_limit:int=IMAGE_QUEUE_LIMIT):
+        self.backend = backend
+        self.workers = workers
+        self.queue_limit = max(queue_limit, workers)
+        if backend == "process":
+            # Forking a process running threads (AWS clients, event loop) can deadlock the child
+            self.executor = concurrent.futures.ProcessPoolExecutor(
+                max_workers=workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=init_worker)
+        else:
+            self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix="image-worker")
+        self.slots = threading.BoundedSemaphore(self.queue_limit)
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.peak = 0
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.wait_seconds = 0.0
+
+    def submit(self,func,*args,timeout:float=IMAGE_QUEUE_TIMEOUT,**kwargs) -> concurrent.futures.Future:
+        """
+        Queue func(*args, **kwargs), waiting up to timeout seconds for a slot
+        (forever when None). Raises Overloaded when none freed up.
+        """
+        started = time.perf_counter()
+        with span("image_pool.wait"):
+            acquired = self.slots.acquire(timeout=timeout)
+        with self.lock:
+            self.wait_seconds += time.perf_counter() - started
+            if not acquired:
+                self.rejected += 1
+                raise Overloaded(f"Image processing is overloaded, {self.queue_limit} tasks in flight")
+            self.in_flight += 1
+            self.peak = max(self.peak, self.in_flight)
+            self.submitted += 1
+        try:
+            if self.backend == "process":
+                future = self.executor.submit(func,*[portable(arg) for arg in args],**kwargs)
+            else:
+                # The context is copied so the spans of the task join the request trace
+                future = self.executor.submit(functools.partial(contextvars.copy_context().run,func,*args,**kwargs))
+        except:
+            self.release(failed=True)
+            raise
+        future.add_done_callback(lambda future: self.release(failed=future.cancelled() or future.exception() is not None))
+        return future
+
+    def release(self,failed:bool):
+        self.slots.release()
+        with self.lock:
+            self.in_flight -= 1
+            if failed:
+                self.failed += 1
+            else:
+                self.completed += 1
+
+    def run(self,func,*args,**kwargs):
+        """
+        Run func(*args, **kwargs) on the pool and return its result, raises Overloaded
+        when the pool stayed full for IMAGE_QUEUE_TIMEOUT seconds
+        """
+        return self.submit(func,*args,**kwargs).result()
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "backend": self.backend,
+                "workers": self.workers,
+                "queue_limit": self.queue_limit,
+                "in_flight": self.in_flight,
+                "queued": max(self.in_flight - self.workers, 0),
+                "peak": self.peak,
+                "submitted": self.submitted,
+                "completed": self.completed,
+                "failed": self.failed,
+                "rejected": self.rejected,
+                "wait_seconds": round(self.wait_seconds, 3)
+            }
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def get_pool() -> ImagePool:
+    """
+    Image pool of the process, created on first use
+    """
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ImagePool()
+    return _pool
+
+def run(func,*args,**kwargs):
+    return get_pool().run(func,*args,**kwargs)
+
+def shutdown():
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown()
+            _pool = None
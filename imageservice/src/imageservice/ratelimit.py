@@ -0,0 +1,320 @@
+"""
+Admission control of the expensive routes.
+When RATE_LIMIT_ENABLED=1, a middleware admits a request to a limited route only when
+-   the token bucket of its user for the route, and the one shared by all users, hold a
+    token (RATE requests per second on average, bursts of BURST)
+-   fewer than CONCURRENCY requests of its user, and of all users, are in progress on
+    the route in this process. On the routes coalescing identical reads (COALESCED_ROUTES)
+    a request over a concurrency limit is still let in, it is only served when all its
+    reads join reads in progress (see aio.coalesce), else it gets the 429/503
+A request over a limit of its user gets a 429, over a global limit a 503, both with a
+Retry-After header. The user is the userId query parameter, else the client address.
+
+The limits of a route are given as PATH=RATE/BURST[:CONCURRENCY], 0 for no limit, in
+RATE_LIMITS per user and in RATE_LIMITS_GLOBAL for all users.
+RATE_LIMIT_BACKEND selects where the buckets are kept
+-   memory : in the process (default)
+-   sqlite : in the SQLite file RATE_LIMIT_PATH, shared by the workers of imageservice.server
+"""
+import contextlib
+import contextvars
+import logging
+import os
+import sqlite3
+import threading
+import time
+import traceback
+from collections import Counter, OrderedDict
+from pydantic import BaseModel
+from starlette.responses import JSONResponse
+
+logger = logging.getLogger(__name__)
+
+RATE_LIMIT_ENABLED = os.environ.get("RATE_LIMIT_ENABLED", "1").lower() in ("1", "true", "yes")
+RATE_LIMIT_BACKEND = os.environ.get("RATE_LIMIT_BACKEND", "memory").lower()
+RATE_LIMIT_PATH = os.environ.get("RATE_LIMIT_PATH", "/tmp/imageservice-ratelimit.sqlite3")
+# Buckets kept by the memory backend, the least recently used are dropped first
+RATE_LIMIT_MAX_KEYS = int(os.environ.get("RATE_LIMIT_MAX_KEYS", "100000"))
+# Seconds after which an unused bucket is full again and dropped by the sqlite backend
+RATE_LIMIT_IDLE = int(os.environ.get("RATE_LIMIT_IDLE", "3600"))
+# Routes whose identical requests share one read in progress, see aio.coalesce
+COALESCED_ROUTES = ("/list", "/view")
+
+class ConcurrencyLimited(Exception):
+    """
+    Raised by aio.coalesce for a request over a concurrency limit which would run a read
+    itself instead of joining one in progress, the routes answer with its response
+    """
+    def __init__(self,response:JSONResponse):
+        super().__init__("Too many requests in progress")
+        self.response = response
+
+class Admission:
+    """
+    Concurrency state of a request let in over a concurrency limit
+    -   waiting : has not read anything yet
+    -   joined : every read so far joined one in progress, not counted
+    -   counted : ran a read itself, counted as in progress
+    """
+    def __init__(self,limiter,path:str,user:str,reason:str):
+        self.limiter = limiter
+        self.path = path
+        self.user = user
+        self.reason = reason
+        self.state = "waiting"
+
+# Admission of the request being served, set by the middleware
+_admission = contextvars.ContextVar("admission", default=None)
+
+def admit(joining:bool):
+    """
+    Called by aio.coalesce before every read, joining one in progress or not. A request let
+    in over a concurrency limit is counted before running a read itself, and raises
+    ConcurrencyLimited when still over the limit.
+    """
+    admission = _admission.get()
+    if admission is None or admission.state == "counted":
+        return
+    limiter = admission.limiter
+    if joining:
+        if admission.state == "waiting":
+            admission.state = "joined"
+            with limiter.lock:
+                limiter.joined += 1
+        return
+    reason = limiter.enter(admission.path,admission.user)
+    if reason is not None:
+        raise ConcurrencyLimited(limiter.reject(reason,1,429 if reason == "user_concurrency" else 503))
+    admission.state = "counted"
+
+class LimitModel(BaseModel):
+    rate : float = 0
+    burst : float = 0
+    concurrency : int = 0
+
+def parse_limits(spec:str) -> dict:
+    """
+    Parse a comma separated list of route limits, each PATH=RATE/BURST[:CONCURRENCY].
+    eg. /list=5/20:2,/view=50/100
+    """
+    limits = {}
+    for entry in filter(None,(entry.strip() for entry in spec.split(","))):
+        path, _, limit = entry.partition("=")
+        bucket, _, concurrency = limit.partition(":")
+        rate, _, burst = bucket.partition("/")
+        try:
+            # A bucket holds at least one token, else it would never admit a request
+            limits[path.strip()] = LimitModel(rate=float(rate or 0),burst=max(float(burst or rate or 0),1),
+                                              concurrency=int(concurrency or 0))
+        except ValueError:
+            raise ValueError(f"Invalid rate limit {entry}")
+    return limits
+
+RATE_LIMITS = parse_limits(os.environ.get("RATE_LIMITS",
+    "/list=5/20:2,/view=50/100:16,/view/batch=5/10:2,/upload=10/20:4,/delete/batch=1/5:1"))
+RATE_LIMITS_GLOBAL = parse_limits(os.environ.get("RATE_LIMITS_GLOBAL",
+    "/list=500/1000:128,/view=2000/4000:512,/view/batch=100/200:32,/upload=200/400:64"))
+
+def refill(tokens:float,updated:float,rate:float,burst:float,now:float) -> tuple:
+    """
+    Take a token from a bucket last left with tokens at updated.
+    Returns the tokens left and the seconds to wait, 0 when the token was taken.
+    """
+    tokens = min(burst, tokens + (now - updated) * rate)
+    if tokens >= 1:
+        return tokens - 1, 0
+    return tokens, (1 - tokens) / rate
+
+class MemoryRateLimitStore:
+    """
+    Token buckets kept in the process
+    """
+    blocking = False
+
+    def __init__(self,max_keys:int=RATE_LIMIT_MAX_KEYS):
+        self.max_keys = max_keys
+        self.buckets = OrderedDict()
+        self.lock = threading.Lock()
+
+    def take(self,key:str,rate:float,burst:float) -> float:
+        now = time.time()
+        with self.lock:
+            tokens, updated = self.buckets.pop(key, (burst, now))
+            tokens, wait = refill(tokens,updated,rate,burst,now)
+            self.buckets[key] = (tokens, now)
+            while len(self.buckets) > self.max_keys:
+                self.buckets.popitem(last=False)
+        return wait
+
+class SqliteRateLimitStore:
+    """
+    Token buckets kept in a SQLite file, so the worker processes of a host share them
+    """
+    blocking = True
+
+    def __init__(self,path:str=RATE_LIMIT_PATH,idle:int=RATE_LIMIT_IDLE):
+        self.path = path
+        self.idle = idle
+        self.takes = 0
+        with contextlib.closing(self.connect()) as db:
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("CREATE TABLE IF NOT EXISTS buckets (key TEXT PRIMARY KEY, tokens REAL, updated REAL)")
+
+    def connect(self) -> sqlite3.Connection:
+        # One connection per call, sqlite3 connections cannot be shared between threads
+        return sqlite3.connect(self.path, timeout=5, isolation_level=None)
+
+    def take(self,key:str,rate:float,burst:float) -> float:
+        now = time.time()
+        with contextlib.closing(self.connect()) as db:
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                row = db.execute("SELECT tokens, updated FROM buckets WHERE key=?", (key,)).fetchone()
+                tokens, wait = refill(*(row or (burst, now)),rate,burst,now)
+                db.execute("INSERT OR REPLACE INTO buckets VALUES (?,?,?)", (key, tokens, now))
+                self.takes += 1
+                if self.takes % 1000 == 0:
+                    db.execute("DELETE FROM buckets WHERE updated < ?", (now - self.idle,))
+                db.execute("COMMIT")
+            except:
+                db.execute("ROLLBACK")
+                raise
+        return wait
+
+class RateLimiter:
+    """
+    Checks the limits of the requests and counts the rejected ones for /metrics
+    :parameters
+    -   store : Store of the token buckets
+    -   limits : Per user limits by route
+    -   global_limits : Limits shared by all users by route
+    """
+    def __init__(self,store,limits:dict=RATE_LIMITS,global_limits:dict=RATE_LIMITS_GLOBAL):
+        self.store = store
+        self.limits = limits
+        self.global_limits = global_limits
+        self.in_progress = Counter()
+        self.lock = threading.Lock()
+        self.admitted = 0
+        self.joined = 0
+        self.rejected = Counter()
+
+    def limited(self,path:str) -> bool:
+        return path in self.limits or path in self.global_limits
+
+    def reject(self,reason:str,retry_after:float,status_code:int) -> JSONResponse:
+        with self.lock:
+            self.rejected[reason] += 1
+        return JSONResponse(
+            content={"Error": f"Too many requests, {reason.replace('_', ' ')} limit reached"},
+            status_code=status_code,
+            headers={"Retry-After": str(max(int(retry_after + 0.999), 1))}
+        )
+
+    async def take(self,key:str,limit:LimitModel) -> float:
+        if not limit.rate:
+            return 0
+        try:
+            if self.store.blocking:
+                from imageservice.aio import run_io
+                return await run_io(self.store.take,key,limit.rate,limit.burst)
+            return self.store.take(key,limit.rate,limit.burst)
+        except:
+            # Fail open, an unavailable store must not take the service down
+            logger.error(f"Failed to check the rate limit of {key} {traceback.format_exc(chain=False)}")
+            return 0
+
+    def enter(self,path:str,user:str) -> str:
+        """
+        Count the request as in progress, returns the reason when a concurrency limit is reached instead
+        """
+        user_key, global_key = f"{path}|{user}", f"{path}|*"
+        user_limit, global_limit = self.limits.get(path), self.global_limits.get(path)
+        with self.lock:
+            if user_limit and user_limit.concurrency and self.in_progress[user_key] >= user_limit.concurrency:
+                return "user_concurrency"
+            if global_limit and global_limit.concurrency and self.in_progress[global_key] >= global_limit.concurrency:
+                return "global_concurrency"
+            self.in_progress[user_key] += 1
+            self.in_progress[global_key] += 1
+            self.admitted += 1
+        return None
+
+    def leave(self,path:str,user:str):
+        with self.lock:
+            for key in (f"{path}|{user}", f"{path}|*"):
+                self.in_progress[key] -= 1
+                if not self.in_progress[key]:
+                    del self.in_progress[key]
+
+    async def middleware(self,request,call_next):
+        path = request.url.path
+        if not self.limited(path):
+            return await call_next(request)
+        user = request.query_params.get("userId") or (request.client.host if request.client else "anonymous")
+        if path in self.limits:
+            wait = await self.take(f"{path}|{user}",self.limits[path])
+            if wait:
+                return self.reject("user_rate",wait,429)
+        if path in self.global_limits:
+            wait = await self.take(f"{path}|*",self.global_limits[path])
+            if wait:
+                return self.reject("global_rate",wait,503)
+        reason = self.enter(path,user)
+        if reason is None:
+            try:
+                return await call_next(request)
+            finally:
+                # Streamed responses are counted until their headers are sent
+                self.leave(path,user)
+        if not self.joinable(request):
+            return self.reject(reason,1,429 if reason == "user_concurrency" else 503)
+        # Served only if its reads join reads in progress, see admit
+        admission = Admission(self,path,user,reason)
+        token = _admission.set(admission)
+        try:
+            return await call_next(request)
+        finally:
+            _admission.reset(token)
+            if admission.state == "counted":
+                self.leave(path,user)
+
+    def joinable(self,request) -> bool:
+        """
+        Whether every read of a request goes through aio.coalesce, streamed and ranged
+        reads do not, and variants negotiated from Accept are left out too
+        """
+        if request.url.path not in COALESCED_ROUTES:
+            return False
+        params = request.query_params
+        if params.get("mode") == "binary" or "range" in request.headers:
+            return False
+        return not ((params.get("width") or params.get("height")) and not params.get("format"))
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "backend": RATE_LIMIT_BACKEND,
+                "admitted": self.admitted,
+                "joined": self.joined,
+                "rejected": dict(self.rejected),
+                "in_progress": sum(count for key, count in self.in_progress.items() if key.endswith("|*"))
+            }
+
+_limiter = None
+_limiter_lock = threading.Lock()
+
+def get_limiter() -> RateLimiter:
+    """
+    Rate limiter of the process, created on first use
+    """
+    global _limiter
+    if _limiter is None:
+        with _limiter_lock:
+            if _limiter is None:
+                store = SqliteRateLimitStore() if RATE_LIMIT_BACKEND == "sqlite" else MemoryRateLimitStore()
+                _limiter = RateLimiter(store)
+    return _limiter
+
+async def middleware(request,call_next):
+    return await get_limiter().middleware(request,call_next)
@@ -1,12 +1,13 @@
 from decimal import Decimal
 from fastapi import APIRouter, Query,Request,Response
-from imageservice.utils import Metadata, MetadataInputModel,ResponseModel
+from imageservice.aio import AsyncMetadata
+from imageservice.utils import BatchInputModel, MetadataInputModel,ResponseModel, reserved_user_id
 from starlette.responses import JSONResponse
 
 router = APIRouter()
 
 @router.post("/delete",response_model=ResponseModel)
-def delete_image(request:Request,
+async def delete_image(request:Request,
                  userId: str = Query(default=None, description="Id of the User to delete images"),
                  timestamp: Decimal = Query(default=None, description="Timestamp of the image creation")):
     """
@@ -15,10 +16,15 @@ def delete_image(request:Request,
     - **timestamp**: The timestamp of the image creation in the App
     """
     userId = request.query_params.get("userId")
+    if reserved_user_id(userId):
+        return JSONResponse(
+            content={"Error": "Invalid userId"},
+            status_code=400
+        )
     timestamp = request.query_params.get("timestamp")
     try:
-        md = Metadata(userId=userId)
-        image = md.delete_item(itemInfo=MetadataInputModel(
+        md = AsyncMetadata(userId=userId)
+        image = await md.delete_item(itemInfo=MetadataInputModel(
             userId=userId,
             timestamp=timestamp
         ))
@@ -37,4 +43,45 @@ def delete_image(request:Request,
         return JSONResponse(
             content=f"Failed to fetch: {e}",
             status_code=500
-        )
\ No newline at end of file
+        )
+
+@router.post("/delete/batch",response_model=ResponseModel)
+async def delete_images(request:Request,
+                 batch: BatchInputModel,
+                 userId: str = Query(default=None, description="Id of the User to delete images")):
+    """
+    API used to delete many images at once
+    - **userId**: The userID of the items to delete in query parameters
+    - **timestamps**: The timestamps of the images to delete, in the request body
+    - **all**: true to delete every image of the user instead, in the request body
+
+    Returns the result of every timestamp
+    """
+    userId = request.query_params.get("userId")
+    if reserved_user_id(userId):
+        return JSONResponse(
+            content={"Error": "Invalid userId"},
+            status_code=400
+        )
+    if not batch.all and not batch.timestamps:
+        return JSONResponse(
+            content={"Error": "Either timestamps or all is required"},
+            status_code=400
+        )
+    try:
+        md = AsyncMetadata(userId=userId)
+        results = await md.delete_items(timestamps=None if batch.all else batch.timestamps)
+        if results is None:
+            return JSONResponse(
+                content="Failed to delete images",
+                status_code=500
+            )
+        return JSONResponse(
+            content={"results": results},
+            status_code=200
+        )
+    except Exception as e:
+        return JSONResponse(
+            content=f"Failed to fetch: {e}",
+            status_code=500
+        )
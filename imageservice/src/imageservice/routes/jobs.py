@@ -0,0 +1,44 @@
+from decimal import Decimal
+from fastapi import APIRouter, Query,Request
+from imageservice import jobs
+from imageservice.aio import run_io
+from imageservice.utils import ResponseModel, reserved_user_id
+from starlette.responses import JSONResponse
+
+router = APIRouter()
+
+@router.get("/jobs",response_model=ResponseModel)
+async def get_jobs(request:Request,
+                   userId: str = Query(default=None, description="Id of the User of the image"),
+                   timestamp: Decimal = Query(default=None, description="Timestamp of the image creation")):
+    """
+    API used to follow the post-upload processing of an image
+    - **userId**: The userID of the item in query parameters
+    - **timestamp**: The timestamp of the image creation, returned by /upload in the X-Image-Timestamp header
+    - **jobs**: kind (thumbnail, enrich, variants), status (queued, running, done, failed), attempts and last error
+    """
+    userId = request.query_params.get("userId")
+    if reserved_user_id(userId):
+        return JSONResponse(
+            content={"Error": "Invalid userId"},
+            status_code=400
+        )
+    timestamp = request.query_params.get("timestamp")
+    try:
+        # The SQLite store blocks, it is read on the I/O executor like the AWS calls
+        job_list = await run_io(jobs.get_queue().get_jobs,userId,Decimal(timestamp))
+        if not job_list:
+            return JSONResponse(
+                content="No jobs found",
+                status_code=404
+            )
+        return JSONResponse(
+            content={"timestamp": timestamp,
+                     "jobs": [job.model_dump(mode="json",exclude={"userId","timestamp"}) for job in job_list]},
+            status_code=200
+        )
+    except Exception as e:
+        return JSONResponse(
+            content=f"Failed to fetch: {e}",
+            status_code=500
+        )
@@ -1,41 +1,124 @@
+import os
 from fastapi import APIRouter, Request, Response,Query
-from imageservice.utils import Metadata, ResponseModel
+from imageservice.http_cache import LIST_CACHE_CONTROL, cache_headers, etag_matches, list_etag, not_modified, variant_etag
+from imageservice.imaging import SPRITE_FORMATS
+from imageservice.processing import Overloaded
+from imageservice.ratelimit import ConcurrencyLimited
+from imageservice.aio import AsyncMetadata, coalesce
+from imageservice.utils import ResponseModel, reserved_user_id
 from starlette.responses import JSONResponse
 
 router = APIRouter()
 
+LIST_MAX_LIMIT = 1000
+# Thumbnails composed at most in one sprite, the page size of mode=sprite without limit
+SPRITE_MAX_TILES = int(os.environ.get("SPRITE_MAX_TILES", "100"))
+
 @router.get("/list",response_model=ResponseModel)
-def list_images(request:Request,
-                userId: str = Query(default=None, description="Id of the User to get images")):
-    
+async def list_images(request:Request,
+                userId: str = Query(default=None, description="Id of the User to get images"),
+                limit: int = Query(default=None, ge=1, le=LIST_MAX_LIMIT, description="Maximum number of images of the page"),
+                cursor: str = Query(default=None, description="next_cursor of the previous page"),
+                order: str = Query(default="asc", pattern="^(asc|desc)$", description="asc for oldest first, desc for newest first"),
+                mode: str = Query(default="json", pattern="^(json|sprite)$", description="json for one base64 thumbnail per image, sprite for one image of all thumbnails"),
+                format: str = Query(default="jpeg", pattern=f"^({'|'.join(SPRITE_FORMATS)})$", description="Format of the sprite")):
+
     """
     API used to list images
     - **userId**: The userID of the item to upload in query parameters
+    - **limit**: Page size, all images are returned when not given
+    - **cursor**: Opaque cursor returned as next_cursor by the previous page
+    - **order**: asc (oldest first) or desc (newest first)
+    - **mode**: json (default) or sprite, a sprite returns the thumbnails of the page as one base64 image
+      with the box (x, y, width, height) of every image in it, pages of SPRITE_MAX_TILES images at most
+    - **format**: jpeg (default), webp or png, format of the sprite
+
+    Responses carry an ETag of the page, a matching If-None-Match is answered with 304 without fetching thumbnails
     """
     userId = request.query_params.get("userId")
+    if reserved_user_id(userId):
+        return JSONResponse(
+            content={"Error": "Invalid userId"},
+            status_code=400
+        )
+    if mode == "sprite":
+        if limit is not None and limit > SPRITE_MAX_TILES:
+            return JSONResponse(
+                content={"Error": f"limit must be at most {SPRITE_MAX_TILES} in sprite mode"},
+                status_code=400
+            )
+        limit = limit or SPRITE_MAX_TILES
     try:
-        md = Metadata(userId=userId)
-        images = md.get_items(
+        md = AsyncMetadata(userId=userId)
+        # Concurrent identical listings share one read of the page and of its thumbnails
+        page = await coalesce(("page",userId,limit,cursor,order),md.get_page,
+            limit=limit,
+            cursor=cursor,
+            newest_first=order == "desc"
         )
+        etag = list_etag(page) if page is not None else None
+        if mode == "sprite":
+            return await list_sprite(request,md,page,etag,format,cursor)
+        if etag and (page.items or cursor) and etag_matches(request.headers.get("if-none-match"),etag):
+            return not_modified(etag,LIST_CACHE_CONTROL)
+        images = await coalesce(("list",userId,etag),md.get_items,page=page) if page is not None else None
         if images:
-            if len(images.get("thumbnails")) > 0:
+            if len(images.get("thumbnails")) > 0 or cursor:
+                # A page with failed items must not be revalidated into a 304
+                complete = all("error" not in thumbnail for thumbnail in images.get("thumbnails"))
                 return JSONResponse(
                     content=images,
-                    status_code=200
+                    status_code=200,
+                    headers=cache_headers(etag if complete else None,LIST_CACHE_CONTROL)
                 )
             else:
                 return JSONResponse(
                     content={"Error": "User not found"},
                     status_code=404
-                ) 
+                )
         else:
             return JSONResponse(
                 content=None,
                 status_code=500
-            )             
-    
+            )
+
+    except ValueError as e:
+        return JSONResponse(
+            content={"Error": str(e)},
+            status_code=400
+        )
+    except Overloaded as e:
+        return JSONResponse(
+            content={"Error": str(e)},
+            status_code=503,
+            headers={"Retry-After": "1"}
+        )
+    except ConcurrencyLimited as e:
+        return e.response
     except Exception as e:
         return JSONResponse(
             content=f"Failed to fetch: {e}",
             status_code=500
-        )
\ No newline at end of file
+        )
+
+async def list_sprite(request:Request,md:AsyncMetadata,page,etag:str,format:str,cursor:str):
+    if page is None:
+        return JSONResponse(
+            content=None,
+            status_code=500
+        )
+    if not page.items and not cursor:
+        return JSONResponse(
+            content={"Error": "User not found"},
+            status_code=404
+        )
+    sprite_etag = variant_etag(etag,f"sprite-{format}")
+    if etag_matches(request.headers.get("if-none-match"),sprite_etag):
+        return not_modified(sprite_etag,LIST_CACHE_CONTROL)
+    sprite = await coalesce(("sprite",md.userId,etag,format),md.get_sprite,page,etag,format)
+    complete = all("error" not in thumbnail for thumbnail in sprite.get("thumbnails"))
+    return JSONResponse(
+        content=sprite,
+        status_code=200,
+        headers=cache_headers(sprite_etag if complete else None,LIST_CACHE_CONTROL)
+    )
@@ -0,0 +1,31 @@
+from fastapi import APIRouter, Request
+from starlette.responses import JSONResponse
+import os
+from imageservice import aio, cache, clients, jobs, processing, ratelimit, startup
+from imageservice.utils import ResponseModel
+
+router = APIRouter()
+
+@router.get("/metrics",response_model=ResponseModel)
+async def metrics(request: Request):
+    """
+    API used to monitor the process
+    - **cache**: Entries, bytes, hit/miss/eviction/expiration/invalidation counters of the in-process caches
+    - **clients**: Seconds spent creating the AWS clients
+    - **startup**: Seconds spent importing and warming up the Lambda container
+    - **jobs**: Backend, jobs in flight and jobs by status of the post-upload queue
+    - **image_pool**: Backend, workers, tasks in flight/queued/rejected and seconds waited for a slot of the image pool
+    - **rate_limit**: Requests admitted, served over a concurrency limit by joining reads in progress, rejected by limit and in progress on the limited routes, when enabled
+    - **coalesced**: Reads of /list and /view run, and the ones served by an identical read in progress
+    - **pid**: Process serving the request, every server worker reports its own counters
+    """
+    return JSONResponse({
+        "cache": cache.stats(),
+        "clients": dict(clients.init_timings),
+        "startup": dict(startup.timings),
+        "jobs": jobs.get_queue().stats(),
+        "image_pool": processing.get_pool().stats(),
+        "rate_limit": ratelimit.get_limiter().stats() if ratelimit.RATE_LIMIT_ENABLED else None,
+        "coalesced": dict(aio.coalesce_stats),
+        "pid": os.getpid()
+    })
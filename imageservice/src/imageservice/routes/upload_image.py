@@ -1,36 +1,93 @@
 import base64
-import io,os
-import uuid
-from fastapi import APIRouter, Query,Request, Body
-from PIL import Image
-from imageservice.utils import Metadata, ResponseModel
+from fastapi import APIRouter, Query,Request
+from imageservice.aio import AsyncMetadata, UPLOAD_PART_SIZE, run_cpu
+from imageservice.imaging import open_image
+from imageservice.tracing import span
+from imageservice.utils import ResponseModel, reserved_user_id
+from starlette.datastructures import UploadFile
 from starlette.responses import JSONResponse
 
 router = APIRouter()
 
-@router.post("/upload",response_model=ResponseModel)
+# The body is read by the route itself so raw uploads can be streamed, it is documented here
+UPLOAD_REQUEST_BODY = {
+    "requestBody": {
+        "content": {
+            "application/json": {"schema": {"type": "string", "description": "Base64 encoded image"}},
+            "application/octet-stream": {"schema": {"type": "string", "format": "binary"}},
+            "multipart/form-data": {"schema": {
+                "type": "object",
+                "properties": {"image": {"type": "string", "format": "binary"}},
+                "required": ["image"]}},
+        }
+    }
+}
+
+async def iter_upload(upload:UploadFile,chunk_size:int=UPLOAD_PART_SIZE):
+    while True:
+        chunk = await upload.read(chunk_size)
+        if not chunk:
+            break
+        yield chunk
+
+@router.post("/upload",response_model=ResponseModel,openapi_extra=UPLOAD_REQUEST_BODY)
 async def upload_image(request:Request,
-                        userId: str = Query(default=None, description="Id of the User to Upload images"),
-                        image: str = Body(default=None, description="Id of the User to Upload images")):
+                        userId: str = Query(default=None, description="Id of the User to Upload images")):
     """
     API used to upload images
     - **userId**: The userID of the item to upload in query parameters
-    - **body**: Image bytes to be sent in request body
+    - **body**: Image to be sent in request body, either
+        - base64 encoded (application/json), kept for compatibility
+        - raw bytes (application/octet-stream or image/*), streamed to S3
+        - a multipart/form-data `image` file, streamed to S3
+    - **X-Image-Timestamp**: Response header with the timestamp of the image, its thumbnail
+      and derivatives are processed in the background and followed with /jobs
     """
-
-    body = await request.body()
     userId = request.query_params.get("userId")
+    if reserved_user_id(userId):
+        return JSONResponse(
+            content={"Error": "Invalid userId"},
+            status_code=400
+        )
+    content_type = request.headers.get("content-type","")
     try:
-        image_bytes = base64.b64decode(body)
-        image = Image.open(io.BytesIO(image_bytes))
-        md = Metadata(userId=userId)
-        md.write_image(image,image_bytes)
+        md = AsyncMetadata(userId=userId)
+        if content_type.startswith("multipart/form-data"):
+            form = await request.form()
+            upload = form.get("image")
+            if not isinstance(upload,UploadFile):
+                return JSONResponse(
+                    content={"Error": "Missing image file"},
+                    status_code=400
+                )
+            model = await md.write_image_stream(iter_upload(upload))
+        elif content_type.startswith(("application/octet-stream","image/")):
+            model = await md.write_image_stream(request.stream())
+        else:
+            body = await request.body()
+            with span("base64.decode"):
+                image_bytes = await run_cpu(base64.b64decode,body)
+            with span("pil.open"):
+                image = await run_cpu(open_image,image_bytes)
+            model = await md.write_image(image,image_bytes)
 
+        if model is None:
+            return JSONResponse(
+                content="Failed to upload",
+                status_code=500
+            )
+        # The thumbnail and the other derivatives follow in the background, see /jobs
         return JSONResponse(
             content="Successfully uploaded",
-            status_code=200
+            status_code=200,
+            headers={"X-Image-Timestamp": str(model.timestamp)}
+        )
+
+    except ValueError as e:
+        return JSONResponse(
+            content={"Error": str(e)},
+            status_code=400
         )
-        
     except Exception as e:
         return JSONResponse(
             content=f"Failed to upload: {e}",
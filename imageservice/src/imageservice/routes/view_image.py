@@ -1,43 +1,225 @@
 import ast
 from decimal import Decimal
 import json
+import os
+import re
 from fastapi import APIRouter, Query,Request,Response
-from imageservice.utils import Metadata,MetadataInputModel, ResponseModel
-from starlette.responses import JSONResponse
+from imageservice.http_cache import IMMUTABLE_CACHE_CONTROL, cache_headers, etag_matches, not_modified, variant_etag
+from imageservice.aio import AsyncMetadata, coalesce
+from imageservice.imaging import VARIANT_FORMATS, supports_format
+from imageservice.processing import Overloaded
+from imageservice.ratelimit import ConcurrencyLimited
+from imageservice.utils import BatchInputModel, InvalidRangeError, MetadataInputModel, MetadaDataResponseModel, ResponseModel, VariantModel, reserved_user_id
+from starlette.responses import JSONResponse, StreamingResponse
 
 
 router = APIRouter()
 
+VIEW_CHUNK_SIZE = int(os.environ.get("VIEW_CHUNK_SIZE", str(64 * 1024)))
+VIEW_BATCH_MAX = int(os.environ.get("VIEW_BATCH_MAX", "100"))
+SINGLE_RANGE = re.compile(r"^bytes=(\d+-\d*|-\d+)$")
+VARIANT_MAX_DIMENSION = int(os.environ.get("VARIANT_MAX_DIMENSION", "4096"))
+
+def negotiate_format(accept:str,original_format:str) -> str:
+    """
+    Pick the variant format from the Accept header, preferring AVIF then WebP,
+    else keeping the format of the original when it can be served
+    """
+    for format in ("avif", "webp"):
+        if f"image/{format}" in (accept or "") and supports_format(format):
+            return format
+    original_format = original_format.lower()
+    return original_format if original_format in VARIANT_FORMATS else "jpeg"
+
+def iter_body(body,chunk_size:int=VIEW_CHUNK_SIZE):
+    """
+    Iterate a S3 StreamingBody in chunks, closing the connection once done
+    """
+    try:
+        yield from body.iter_chunks(chunk_size)
+    finally:
+        body.close()
+
+async def stream_image(request:Request,md:AsyncMetadata,itemInfo:MetadataInputModel,metadata:MetadaDataResponseModel,etag:str):
+    # Only single ranges are forwarded, anything else is ignored and served in full
+    byte_range = request.headers.get("range","").replace(" ","")
+    if not SINGLE_RANGE.match(byte_range):
+        byte_range = None
+    try:
+        item = await md.get_item_stream(itemInfo=itemInfo,byte_range=byte_range,metadata=metadata)
+    except InvalidRangeError as e:
+        return JSONResponse(
+            content={"Error": str(e)},
+            status_code=416
+        )
+    if not item:
+        return JSONResponse(
+            content={"Error": "File not found"},
+            status_code=404
+        )
+    s3_object = item.get("object")
+    headers = {
+        "Accept-Ranges": "bytes",
+        "Content-Length": str(s3_object.get("ContentLength")),
+        **cache_headers(etag or s3_object.get("ETag"),IMMUTABLE_CACHE_CONTROL)
+    }
+    if s3_object.get("ContentRange"):
+        headers["Content-Range"] = s3_object.get("ContentRange")
+    return StreamingResponse(
+        iter_body(s3_object["Body"]),
+        status_code=206 if s3_object.get("ContentRange") else 200,
+        media_type=s3_object.get("ContentType"),
+        headers=headers
+    )
+
 @router.get("/view",response_model=ResponseModel)
-def view_image(request:Request,
+async def view_image(request:Request,
                 userId: str = Query(default=None, description="Id of the User to view images"),
-                 timestamp: Decimal = Query(default=None, description="Timestamp of the image creation")):
+                 timestamp: Decimal = Query(default=None, description="Timestamp of the image creation"),
+                 mode: str = Query(default="json", pattern="^(json|binary)$", description="json for base64 in JSON, binary to stream the image bytes"),
+                 width: int = Query(default=None, ge=1, le=VARIANT_MAX_DIMENSION, description="Width of the variant"),
+                 height: int = Query(default=None, ge=1, le=VARIANT_MAX_DIMENSION, description="Height of the variant"),
+                 fit: str = Query(default="contain", pattern="^(contain|cover|fill)$", description="How the variant fits width x height"),
+                 format: str = Query(default=None, pattern="^(jpeg|png|webp|avif)$", description="Format of the variant, negotiated from Accept when not given"),
+                 quality: int = Query(default=85, ge=1, le=100, description="Encoder quality of the variant")):
     """
     API used to view image
     - **userId**: The userID of the item to view in query parameters
     - **timestamp**: The timestamp of the image creation in the App
+    - **mode**: json (base64 encoded image in JSON, kept for compatibility) or binary (streamed image bytes, supports Range requests)
+    - **width**, **height**, **fit**, **format**, **quality**: Return a resized/converted variant of the image instead (binary).
+      Variants are stored once rendered, WebP/AVIF are picked from the Accept header when no format is given
+
+    Responses carry a strong ETag, a matching If-None-Match is answered with 304 without reading the image
     """
     userId = request.query_params.get("userId")
+    if reserved_user_id(userId):
+        return JSONResponse(
+            content={"Error": "Invalid userId"},
+            status_code=400
+        )
     timestamp = request.query_params.get("timestamp")
     try:
-        md = Metadata(userId=userId)
-        image = md.get_item(itemInfo=MetadataInputModel(
+        md = AsyncMetadata(userId=userId)
+        itemInfo = MetadataInputModel(
             userId=userId,
             timestamp=Decimal(timestamp)
-        ))
+        )
+        metadata = await md.get_meta_item(itemInfo)
+        if metadata is None:
+            return JSONResponse(
+                content="Failed to fetch metadata",
+                status_code=500
+            )
+        if not metadata:
+            return JSONResponse(
+                content={"Error": "File not found"},
+                status_code=404
+            )
+        etag = await md.get_item_etag(metadata)
+        variant = None
+        vary = None
+        if width or height or format:
+            if format is None:
+                vary = "Accept"
+            variant = VariantModel(width=width,height=height,fit=fit,quality=quality,
+                                   format=format or negotiate_format(request.headers.get("accept"),metadata.format))
+            if not supports_format(variant.format):
+                return JSONResponse(
+                    content={"Error": f"Format {variant.format} is not supported"},
+                    status_code=400
+                )
+            etag = variant_etag(etag,variant.name)
+        if etag_matches(request.headers.get("if-none-match"),etag):
+            return not_modified(etag,IMMUTABLE_CACHE_CONTROL,vary)
+        if variant is not None:
+            body = await coalesce(("variant",userId,metadata.timestamp,variant.name),md.get_variant,metadata,variant)
+            if body is None:
+                return JSONResponse(
+                    content={"Error": "File not found"},
+                    status_code=404
+                )
+            return Response(
+                content=body,
+                media_type=f"image/{variant.format}",
+                headers=cache_headers(etag,IMMUTABLE_CACHE_CONTROL,vary)
+            )
+        if mode == "binary":
+            return await stream_image(request,md,itemInfo,metadata,etag)
+        # Concurrent views of the same image share one read
+        image = await coalesce(("view",userId,metadata.timestamp),md.get_item,itemInfo=itemInfo,metadata=metadata)
         if image.get("image"):
             return JSONResponse(
                 content=image,
-                status_code=200
+                status_code=200,
+                headers=cache_headers(etag,IMMUTABLE_CACHE_CONTROL)
             )
         else:
             return JSONResponse(
                 content={"Error": "File not found"},
                 status_code=404
-            )           
-        
+            )
+
+    except Overloaded as e:
+        return JSONResponse(
+            content={"Error": str(e)},
+            status_code=503,
+            headers={"Retry-After": "1"}
+        )
+    except ConcurrencyLimited as e:
+        return e.response
+    except Exception as e:
+        return JSONResponse(
+            content=f"Failed to fetch: {e}",
+            status_code=500
+        )
+
+@router.post("/view/batch",response_model=ResponseModel)
+async def view_images(request:Request,
+                batch: BatchInputModel,
+                userId: str = Query(default=None, description="Id of the User to view images")):
+    """
+    API used to view many images at once
+    - **userId**: The userID of the items to view in query parameters
+    - **timestamps**: The timestamps of the images to view, in the request body
+    - **all**: true to view every image of the user instead, in the request body
+
+    Returns the base64 encoded image of every timestamp, at most VIEW_BATCH_MAX of them
+    """
+    userId = request.query_params.get("userId")
+    if reserved_user_id(userId):
+        return JSONResponse(
+            content={"Error": "Invalid userId"},
+            status_code=400
+        )
+    if not batch.all and not batch.timestamps:
+        return JSONResponse(
+            content={"Error": "Either timestamps or all is required"},
+            status_code=400
+        )
+    try:
+        md = AsyncMetadata(userId=userId)
+        timestamps = batch.timestamps
+        if batch.all:
+            page = await md.get_page()
+            timestamps = [item.timestamp for item in page.items] if page is not None else None
+        if timestamps is not None and len(timestamps) > VIEW_BATCH_MAX:
+            return JSONResponse(
+                content={"Error": f"At most {VIEW_BATCH_MAX} images per batch, use /list to page through them"},
+                status_code=400
+            )
+        images = await md.get_items_batch(timestamps=timestamps) if timestamps is not None else None
+        if images is None:
+            return JSONResponse(
+                content="Failed to fetch images",
+                status_code=500
+            )
+        return JSONResponse(
+            content={"images": images},
+            status_code=200
+        )
     except Exception as e:
         return JSONResponse(
             content=f"Failed to fetch: {e}",
             status_code=500
-        )
\ No newline at end of file
+        )
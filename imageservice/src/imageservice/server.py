@@ -0,0 +1,48 @@
+"""
+Production entry point, serves the API on several uvicorn worker processes
+- PYTHONPATH=src python3 -m imageservice.server
+- PYTHONPATH=src python3 -m imageservice.server --workers 4 --port 8080
+
+Every worker runs its own event loop and sends the image work to its own pool of
+IMAGE_WORKERS processes (see processing), by default the cores divided by the workers,
+so one container uses all its cores on image heavy traffic.
+"""
+import argparse
+import os
+
+SERVER_HOST = os.environ.get("SERVER_HOST", "0.0.0.0")
+SERVER_PORT = int(os.environ.get("SERVER_PORT", "8000"))
+SERVER_WORKERS = int(os.environ.get("SERVER_WORKERS", str(os.cpu_count() or 1)))
+# Connections served at once per worker, the next ones get a 503, unlimited when 0
+SERVER_LIMIT_CONCURRENCY = int(os.environ.get("SERVER_LIMIT_CONCURRENCY", "0"))
+SERVER_BACKLOG = int(os.environ.get("SERVER_BACKLOG", "2048"))
+SERVER_KEEPALIVE = int(os.environ.get("SERVER_KEEPALIVE", "5"))
+SERVER_LOG_LEVEL = os.environ.get("SERVER_LOG_LEVEL", "info")
+
+def serve(host:str=SERVER_HOST,port:int=SERVER_PORT,workers:int=SERVER_WORKERS,limit_concurrency:int=SERVER_LIMIT_CONCURRENCY):
+    import uvicorn
+    # Inherited by the worker processes, read when they import the service
+    os.environ.setdefault("IMAGE_POOL", "process")
+    os.environ.setdefault("IMAGE_WORKERS", str(max((os.cpu_count() or 1) // workers, 1)))
+    uvicorn.run(
+        "imageservice.api:app",
+        host=host,
+        port=port,
+        workers=workers,
+        limit_concurrency=limit_concurrency or None,
+        backlog=SERVER_BACKLOG,
+        timeout_keep_alive=SERVER_KEEPALIVE,
+        log_level=SERVER_LOG_LEVEL,
+        proxy_headers=True
+    )
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve the API on several worker processes")
+    parser.add_argument("--host", default=SERVER_HOST, help="Interface to bind")
+    parser.add_argument("--port", type=int, default=SERVER_PORT, help="Port to bind")
+    parser.add_argument("--workers", type=int, default=SERVER_WORKERS, help="uvicorn worker processes")
+    parser.add_argument("--limit-concurrency", type=int, default=SERVER_LIMIT_CONCURRENCY,
+                        help="Connections served at once per worker, unlimited when 0")
+    args = parser.parse_args()
+
+    serve(host=args.host,port=args.port,workers=max(args.workers,1),limit_concurrency=args.limit_concurrency)
@@ -0,0 +1,41 @@
+"""
+Cold start of the Lambda container.
+The time spent importing the service and initialising it is measured here, logged once
+at the end of the init phase and exposed by /metrics. The optional warm-up creates the
+AWS clients and loads the PIL plugins during the init phase, so the first request does
+not pay for them.
+"""
+import contextlib
+import json
+import logging
+import os
+import time
+
+logger = logging.getLogger(__name__)
+
+WARMUP_ENABLED = os.environ.get("IMAGESERVICE_WARMUP", "1").lower() in ("1", "true", "yes")
+
+# Seconds spent in each cold start stage, eg. import, warm_up
+timings = {}
+
+@contextlib.contextmanager
+def measure(name:str):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[name] = time.perf_counter() - started
+
+def warm_up():
+    """
+    Create the shared AWS clients and load PIL ahead of the first request
+    """
+    from imageservice.utils import warm_clients
+    with measure("warm_up.clients"):
+        warm_clients()
+    with measure("warm_up.pil"):
+        from PIL import Image
+        Image.init()
+
+def report():
+    logger.info(json.dumps({"cold_start_ms": {name: round(duration * 1000, 3) for name, duration in timings.items()}}))
@@ -0,0 +1,122 @@
+"""
+Per-request performance tracing.
+When IMAGESERVICE_TRACING=1, a middleware opens a trace for every request, AWS calls are
+timed through botocore events and image operations through spans. The stage timings,
+AWS call counts and bytes transferred are logged as one JSON line per request and
+returned in the Server-Timing header. When disabled nothing is registered and span()
+only costs a context variable lookup.
+"""
+import collections
+import contextlib
+import contextvars
+import json
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+TRACING_ENABLED = os.environ.get("IMAGESERVICE_TRACING", "0").lower() in ("1", "true", "yes")
+
+_current = contextvars.ContextVar("imageservice_trace", default=None)
+
+class Trace:
+    """
+    Stage timings of one request, spans can be added from any thread
+    """
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.lock = threading.Lock()
+        self.stages = collections.defaultdict(lambda: [0, 0.0])
+        self.aws_calls = collections.Counter()
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def add(self,name:str,duration:float,bytes_in:int=0,bytes_out:int=0):
+        with self.lock:
+            stage = self.stages[name]
+            stage[0] += 1
+            stage[1] += duration
+            self.bytes_in += bytes_in
+            self.bytes_out += bytes_out
+
+    def summary(self) -> dict:
+        with self.lock:
+            return {
+                "duration_ms": round((time.perf_counter() - self.started) * 1000, 3),
+                "stages": {name: {"count": count, "ms": round(duration * 1000, 3)}
+                           for name, (count, duration) in self.stages.items()},
+                "aws_calls": dict(self.aws_calls),
+                "bytes_in": self.bytes_in,
+                "bytes_out": self.bytes_out,
+            }
+
+    def server_timing(self) -> str:
+        # Stages running concurrently add up, so a stage total can exceed the request total
+        with self.lock:
+            metrics = [f'{name};dur={duration * 1000:.1f};desc="x{count}"'
+                       for name, (count, duration) in self.stages.items()]
+        metrics.append(f"total;dur={(time.perf_counter() - self.started) * 1000:.1f}")
+        return ", ".join(metrics)
+
+def current() -> Trace:
+    return _current.get()
+
+@contextlib.contextmanager
+def span(name:str):
+    """
+    Time a stage of the current request, a no-op outside of a traced request
+    """
+    trace = _current.get()
+    if trace is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        trace.add(name, time.perf_counter() - started)
+
+def before_aws_call(event_name:str,params:dict,context:dict,**kwargs):
+    trace = _current.get()
+    if trace is None:
+        return
+    context["trace_started"] = time.perf_counter()
+    body = params.get("body")
+    context["trace_bytes_out"] = len(body) if isinstance(body,(bytes,bytearray,str)) else 0
+
+def after_aws_call(event_name:str,http_response,context:dict,**kwargs):
+    trace = _current.get()
+    if trace is None or "trace_started" not in context:
+        return
+    # after-call.s3.GetObject -> s3.GetObject
+    operation = event_name.split(".",1)[1]
+    with trace.lock:
+        trace.aws_calls[operation] += 1
+    trace.add(operation, time.perf_counter() - context.pop("trace_started"),
+              bytes_in=int(http_response.headers.get("content-length") or 0) if http_response is not None else 0,
+              bytes_out=context.pop("trace_bytes_out", 0))
+
+def instrument(client):
+    """
+    Time every call of a botocore client, called by the client registry when tracing is enabled
+    """
+    client.meta.events.register("before-call", before_aws_call)
+    client.meta.events.register("after-call", after_aws_call)
+    return client
+
+async def middleware(request,call_next):
+    trace = Trace()
+    token = _current.set(trace)
+    try:
+        response = await call_next(request)
+    finally:
+        _current.reset(token)
+    response.headers["Server-Timing"] = trace.server_timing()
+    logger.info(json.dumps({
+        "method": request.method,
+        "path": request.url.path,
+        "status": response.status_code,
+        **trace.summary()}))
+    return response
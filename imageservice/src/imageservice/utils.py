@@ -1,18 +1,53 @@
 import base64
+import concurrent.futures
+import contextvars
 import datetime
-from decimal import Decimal
+from decimal import Decimal, InvalidOperation
+import hashlib
+import json
 import os
+import threading
 import time
 import traceback
 import typing
-import boto3
 import logging
-from PIL import Image
-from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
-from io import BytesIO
+from imageservice import clients
+from imageservice.tracing import span
+from imageservice.cache import metadata_cache, thumbnail_cache
+from imageservice import jobs, processing
+from imageservice.imaging import VARIANT_FITS, VARIANT_FORMATS, make_sprite, make_thumbnail, read_exif, render_variant
+
+logger = logging.getLogger(__name__)
+
+# Concurrency and per-item time budget of the /list thumbnail pipeline
+LIST_MAX_WORKERS = int(os.environ.get("LIST_MAX_WORKERS", "8"))
+LIST_ITEM_TIMEOUT = float(os.environ.get("LIST_ITEM_TIMEOUT", "10"))
+# Seconds a whole /list waits for its items, the ones not done by then are reported as timed out
+LIST_REQUEST_TIMEOUT = float(os.environ.get("LIST_REQUEST_TIMEOUT", "30"))
+
+# Request size limits of the batch APIs
+DYNAMODB_BATCH_GET_SIZE = 100
+S3_DELETE_OBJECTS_SIZE = 1000
+BATCH_GET_ATTEMPTS = 5
+
+_list_executor = None
+_list_executor_lock = threading.Lock()
+
+def get_list_executor() -> concurrent.futures.ThreadPoolExecutor:
+    """
+    Process wide worker pool shared by the /list requests, bounding the S3 GETs
+    and image work in flight regardless of the number of concurrent requests
+    """
+    global _list_executor
+    if _list_executor is None:
+        with _list_executor_lock:
+            if _list_executor is None:
+                _list_executor = concurrent.futures.ThreadPoolExecutor(
+                    max_workers=LIST_MAX_WORKERS,
+                    thread_name_prefix="list-worker")
+    return _list_executor
 
-logger = logging.Logger(None,"INFO")
 class ResponseModel(BaseModel):
     content : typing.Union[typing.Mapping,str]
     status_code: int
@@ -22,17 +57,121 @@ class MetadataModel(BaseModel):
     timestamp :typing.Optional[Decimal] = None
     format : str
     size : tuple
+    thumbnail : typing.Optional[str] = None
+    content_hash : typing.Optional[str] = None
+    blob : typing.Optional[str] = None
+    variants : typing.Optional[typing.List[str]] = None
+    byte_size : typing.Optional[int] = None
+    taken_at : typing.Optional[str] = None
+    camera : typing.Optional[str] = None
 
 class MetadaDataResponseModel(BaseModel):
     userId:str
     timestamp:typing.Optional[Decimal] = None
     format : str
     size : tuple
+    thumbnail : typing.Optional[str] = None
+    content_hash : typing.Optional[str] = None
+    blob : typing.Optional[str] = None
+    variants : typing.Optional[typing.List[str]] = None
+    byte_size : typing.Optional[int] = None
+    taken_at : typing.Optional[str] = None
+    camera : typing.Optional[str] = None
+
+class ListPageModel(BaseModel):
+    items : typing.List[MetadaDataResponseModel]
+    next_cursor : typing.Optional[str] = None
 
 class MetadataInputModel(BaseModel):
     userId:str
     timestamp:typing.Optional[Decimal] = None
 
+class VariantModel(BaseModel):
+    width : typing.Optional[int] = None
+    height : typing.Optional[int] = None
+    fit : str = "contain"
+    format : str = "jpeg"
+    quality : int = 85
+
+    @property
+    def name(self) -> str:
+        # Deterministic, so the same request maps to the same stored derivative
+        return f"{self.width or 0}x{self.height or 0}_{self.fit}_q{self.quality}.{self.format}"
+
+def parse_variants(spec:str) -> list:
+    """
+    Parse a comma separated list of variants, each WIDTHxHEIGHT[:fit[:format]], 0 for a free dimension.
+    eg. 320x0,1024x768:cover:webp
+    """
+    variants = []
+    for entry in filter(None,(entry.strip() for entry in spec.split(","))):
+        box, _, options = entry.partition(":")
+        fit, _, format = options.partition(":")
+        width, _, height = box.lower().partition("x")
+        variant = VariantModel(width=int(width) or None,height=int(height or 0) or None,
+                               fit=fit or "contain",format=format or "jpeg")
+        if variant.fit not in VARIANT_FITS or variant.format not in VARIANT_FORMATS:
+            raise ValueError(f"Invalid variant {entry}")
+        variants.append(variant)
+    return variants
+
+# Variants rendered in the background after every upload, none by default
+UPLOAD_VARIANTS = parse_variants(os.environ.get("UPLOAD_VARIANTS", ""))
+# Bytes of the original read to find its EXIF block
+EXIF_HEAD_BYTES = 64 * 1024
+
+class BatchInputModel(BaseModel):
+    timestamps : typing.Optional[typing.List[Decimal]] = None
+    all : bool = False
+
+class InvalidRangeError(ValueError):
+    """
+    Raised when the requested byte range cannot be satisfied by the stored object
+    """
+
+# Originals are stored once per content under BLOB_PREFIX, shared by reference count.
+# The reference counts and the upload markers live in the metadata table under these
+# userId prefixes, which are therefore reserved
+BLOB_PREFIX = "blobs/"
+BLOB_REF_PREFIX = "blob#"
+UPLOAD_MARKER_PREFIX = "upload#"
+# Seconds a retried upload waits for a concurrent one of the same content to be stored
+UPLOAD_CLAIM_WAIT = float(os.environ.get("UPLOAD_CLAIM_WAIT", "10"))
+# Seconds after which a claim still pending is left by an upload which died, and is taken over
+UPLOAD_CLAIM_TTL = float(os.environ.get("UPLOAD_CLAIM_TTL", "300"))
+UPLOAD_CLAIM_POLL = 0.2
+
+def reserved_user_id(userId:str) -> bool:
+    """
+    Whether the userId is one of the reserved keys of the metadata table
+    """
+    return bool(userId) and userId.startswith((BLOB_REF_PREFIX,UPLOAD_MARKER_PREFIX))
+
+def content_hash(body:bytes) -> str:
+    """
+    Hex SHA-256 of the image content, stable for the lifetime of the stored object
+    """
+    return hashlib.sha256(body).hexdigest()
+
+def encode_cursor(last_key:dict) -> str:
+    """
+    Encode the DynamoDB LastEvaluatedKey of a page as an opaque /list cursor
+    """
+    if not last_key:
+        return None
+    payload = json.dumps({"timestamp": str(last_key["timestamp"])}).encode("utf-8")
+    return base64.urlsafe_b64encode(payload).decode("utf-8")
+
+def decode_cursor(cursor:str,userId:str) -> dict:
+    """
+    Decode a /list cursor to the ExclusiveStartKey of the next page, raises ValueError when invalid
+    """
+    try:
+        payload = json.loads(base64.urlsafe_b64decode(cursor.encode("utf-8")))
+        return {"userId": userId, "timestamp": Decimal(payload["timestamp"])}
+    except (ValueError, TypeError, KeyError, InvalidOperation) as e:
+        raise ValueError(f"Invalid cursor {cursor}") from e
+
 class S3Writer():
     """
     S3Writer class to Put, Get and Delete the Images/objects
@@ -40,7 +179,7 @@ class S3Writer():
     """
     def __init__(self):
         self.bucket_name = "imageservice-storage-bucket" #os.environ.get("IMAGE_BUCKET_NAME")
-        self.client = boto3.client("s3")
+        self.client = clients.get_s3_client()
     
     def upload_image(self,metadata:MetadataModel,body:bytes):
         """
@@ -58,15 +197,209 @@ class S3Writer():
             Body=body,
             ContentType=f"image/{metadata.format.lower()}",
         )
-            logging.info(f"Successfully uploaded the image to the path {self.bucket_name}/{key}")
+            logger.info(f"Successfully uploaded the image to the path {self.bucket_name}/{key}")
             return True
         except:
-            logging.error(f"Failed to upload the object, Reason {traceback.format_exc(chain=False)}")
+            logger.error(f"Failed to upload the object, Reason {traceback.format_exc(chain=False)}")
             return False
     
+    def create_multipart_upload(self,metadata:MetadataModel) -> str:
+        """
+        S3Writer function to start a multipart upload of an image to its staging key, returns its UploadId
+        :parameters
+        -   metadata : Metadata of the image to be stored
+        """
+        try:
+            response = self.client.create_multipart_upload(
+                Bucket=self.bucket_name,
+                Key=self.get_staging_path_from_metadata(itemInfo=metadata),
+                ContentType=f"image/{metadata.format.lower()}",
+            )
+            return response["UploadId"]
+        except:
+            logger.error(f"Failed to create the multipart upload, Reason {traceback.format_exc(chain=False)}")
+            return None
+
+    def upload_part(self,metadata:MetadataModel,upload_id:str,part_number:int,body:bytes) -> dict:
+        """
+        S3Writer function to upload one part of a multipart upload, returns the part to complete it with
+        :parameters
+        -   upload_id : UploadId returned by create_multipart_upload
+        -   part_number : Number of the part, starting at 1
+        -   body : Content of the part, at least 5 MiB except for the last part
+        """
+        try:
+            response = self.client.upload_part(
+                Bucket=self.bucket_name,
+                Key=self.get_staging_path_from_metadata(itemInfo=metadata),
+                UploadId=upload_id,
+                PartNumber=part_number,
+                Body=body,
+            )
+            return {"PartNumber": part_number, "ETag": response["ETag"]}
+        except:
+            logger.error(f"Failed to upload the part {part_number}, Reason {traceback.format_exc(chain=False)}")
+            return None
+
+    def complete_multipart_upload(self,metadata:MetadataModel,upload_id:str,parts:list) -> bool:
+        key = self.get_staging_path_from_metadata(itemInfo=metadata)
+        try:
+            self.client.complete_multipart_upload(
+                Bucket=self.bucket_name,
+                Key=key,
+                UploadId=upload_id,
+                MultipartUpload={"Parts": parts},
+            )
+            logger.info(f"Successfully uploaded the image to the path {self.bucket_name}/{key}")
+            return True
+        except:
+            logger.error(f"Failed to complete the multipart upload, Reason {traceback.format_exc(chain=False)}")
+            return False
+
+    def abort_multipart_upload(self,metadata:MetadataModel,upload_id:str) -> bool:
+        try:
+            self.client.abort_multipart_upload(
+                Bucket=self.bucket_name,
+                Key=self.get_staging_path_from_metadata(itemInfo=metadata),
+                UploadId=upload_id,
+            )
+            return True
+        except:
+            logger.error(f"Failed to abort the multipart upload, Reason {traceback.format_exc(chain=False)}")
+            return False
+
+    def upload_thumbnail(self,metadata:MetadataModel,body:bytes):
+        """
+        S3Writer Upload function to Put the thumbnail derivative next to the original
+        :parameters
+        -   metadata : Metadata of the original image
+        -   body : Content of the thumbnail
+        """
+        key = self.get_thumbnail_path_from_metadata(itemInfo=metadata)
+        try:
+            self.client.put_object(
+            Bucket=self.bucket_name,
+            Key=key,
+            Body=body,
+            ContentType="image/jpeg",
+        )
+            logger.info(f"Successfully uploaded the thumbnail to the path {self.bucket_name}/{key}")
+            return key
+        except:
+            logger.error(f"Failed to upload the thumbnail, Reason {traceback.format_exc(chain=False)}")
+            return None
+
+    def put_object(self,key:str,body:bytes,content_type:str) -> bool:
+        """
+        S3Writer Upload function to Put a derivative object
+        :parameters
+        -   key : S3 Key of the object to be stored
+        -   body : Content of the object
+        -   content_type : Content type of the object
+        """
+        try:
+            self.client.put_object(
+            Bucket=self.bucket_name,
+            Key=key,
+            Body=body,
+            ContentType=content_type,
+        )
+            return True
+        except:
+            logger.error(f"Failed to upload the object, Reason {traceback.format_exc(chain=False)}")
+            return False
+
     def get_file_path_from_metadata(self,itemInfo:MetadataModel) -> str:
+        if itemInfo.blob:
+            return itemInfo.blob
+        return self.get_staging_path_from_metadata(itemInfo=itemInfo)
+
+    def get_staging_path_from_metadata(self,itemInfo:MetadataModel) -> str:
+        # Key of the items stored before deduplication, and of the streamed uploads until their hash is known
         return "/".join([itemInfo.userId,str(itemInfo.timestamp),f'{str(itemInfo.timestamp)}.{itemInfo.format.lower()}'])
-    
+
+    def get_blob_path(self,content_hash:str,format:str) -> str:
+        return f"{BLOB_PREFIX}{content_hash}.{format.lower()}"
+
+    def get_thumbnail_path_from_metadata(self,itemInfo:MetadataModel) -> str:
+        if itemInfo.blob:
+            # Shared by every item of the blob, like the original
+            return f"{BLOB_PREFIX}{itemInfo.content_hash}_thumbnail.jpeg"
+        return "/".join([itemInfo.userId,str(itemInfo.timestamp),f'{str(itemInfo.timestamp)}_thumbnail.jpeg'])
+
+    def get_variant_path_from_metadata(self,itemInfo:MetadataModel,variant:VariantModel) -> str:
+        return "/".join([itemInfo.userId,str(itemInfo.timestamp),"variants",variant.name])
+
+    def get_sprite_path(self,userId:str,etag:str,format:str) -> str:
+        # Keyed by the ETag of the /list page, a page whose items change gets a new sprite
+        digest = etag.strip('W/"')
+        return self.get_sprite_prefix(userId) + f"{digest}.{format}.json"
+
+    def get_sprite_prefix(self,userId:str) -> str:
+        return "/".join(["sprites",userId,""])
+
+    def get_object_bytes(self,key:str) -> bytes:
+        """
+        S3Writer Get function to read the raw content of an object
+        :parameters
+        -   key : S3 Key of the stored object
+        """
+        logger.info(key)
+        try:
+            response = self.client.get_object(
+                        Bucket=self.bucket_name,
+                        Key=key
+                    )
+            return response["Body"].read()
+        except:
+            logger.error(f"Failed to get the object, Reason {traceback.format_exc(chain=False)}")
+            return None
+
+    def object_exists(self,key:str) -> bool:
+        """
+        S3Writer Head function checking whether an object is stored, raises on any other error than a missing key
+        """
+        try:
+            self.client.head_object(Bucket=self.bucket_name,Key=key)
+            return True
+        except Exception as e:
+            if clients.error_code(e) in ("NoSuchKey","404"):
+                return False
+            raise
+
+    def copy_object(self,source_key:str,key:str) -> bool:
+        """
+        S3Writer Copy function, the content is copied by S3 without going through the service
+        :parameters
+        -   source_key : S3 Key of the stored object
+        -   key : S3 Key of the copy
+        """
+        try:
+            self.client.copy_object(
+                Bucket=self.bucket_name,
+                Key=key,
+                CopySource={"Bucket": self.bucket_name, "Key": source_key},
+            )
+            return True
+        except:
+            logger.error(f"Failed to copy the object, Reason {traceback.format_exc(chain=False)}")
+            return False
+
+    def get_object_if_exists(self,key:str) -> bytes:
+        """
+        S3Writer Get function for objects which may not exist yet, a missing key returns None quietly
+        """
+        try:
+            response = self.client.get_object(
+                        Bucket=self.bucket_name,
+                        Key=key
+                    )
+            return response["Body"].read()
+        except Exception as e:
+            if clients.error_code(e) not in ("NoSuchKey","404"):
+                logger.error(f"Failed to get the object, Reason {traceback.format_exc(chain=False)}")
+            return None
+
     def get_image(self,itemInfo:MetadaDataResponseModel) -> bytes:
         """
         S3Writer Get function to Get the Images/objects
@@ -76,20 +409,60 @@ class S3Writer():
         # s3://imagebucket2345/122445/1734786841/1734786841.jpeg
         # s3://imagebucket2345/122445/1734786033/1734786033.jpeg
 
-        key = self.get_file_path_from_metadata(itemInfo=itemInfo)
-        logger.info(key)
+        body = self.get_object_bytes(key=self.get_file_path_from_metadata(itemInfo=itemInfo))
+        if body is None:
+            return False
+        with span("base64.encode"):
+            return base64.b64encode(body).decode('utf-8')
+
+    def get_image_stream(self,itemInfo:MetadaDataResponseModel,byte_range:str=None) -> dict:
+        """
+        S3Writer Get function returning the GetObject response without reading the body,
+        so the caller can stream the StreamingBody in chunks
+        :parameters
+        -   itemInfo : Metadata of the stored object
+        -   byte_range : HTTP Range header value, eg. bytes=0-1023
+        """
+        kwargs = {
+            "Bucket": self.bucket_name,
+            "Key": self.get_file_path_from_metadata(itemInfo=itemInfo)
+        }
+        if byte_range:
+            kwargs["Range"] = byte_range
         try:
-            response = self.client.get_object(
+            return self.client.get_object(**kwargs)
+        except Exception as e:
+            if clients.error_code(e) == "InvalidRange":
+                raise InvalidRangeError(f"Range {byte_range} not satisfiable") from e
+            logger.error(f"Failed to get the object, Reason {traceback.format_exc(chain=False)}")
+            return None
+
+    def head_image(self,itemInfo:MetadaDataResponseModel) -> dict:
+        """
+        S3Writer Head function to get the object headers (ETag, ContentLength..) without its body
+        :parameters
+        -   itemInfo : Metadata of the stored object
+        """
+        try:
+            return self.client.head_object(
                         Bucket=self.bucket_name,
-                        Key=key
+                        Key=self.get_file_path_from_metadata(itemInfo=itemInfo)
                     )
-            image_stream =  base64.b64encode(response["Body"].read()).decode('utf-8')
-            # BytesIO(response["Body"].read())
-            return image_stream
-        
         except:
-            logging.error(f"Failed to get the object, Reason {traceback.format_exc(chain=False)}")
-            return False        
+            logger.error(f"Failed to head the object, Reason {traceback.format_exc(chain=False)}")
+            return None
+
+    def get_thumbnail(self,itemInfo:MetadaDataResponseModel) -> str:
+        """
+        S3Writer Get function to Get the stored thumbnail derivative, base64 encoded
+        :parameters
+        -   itemInfo : Metadata item holding the thumbnail key
+        """
+        body = self.get_object_bytes(key=itemInfo.thumbnail)
+        if body is None:
+            return False
+        with span("base64.encode"):
+            return base64.b64encode(body).decode('utf-8')
            
     def delete_image(self,itemInfo:MetadaDataResponseModel) -> bool:
         """
@@ -105,84 +478,475 @@ class S3Writer():
                     )
             return True
         except:
-            logging.error(f"Failed to delete the object, Reason {traceback.format_exc(chain=False)}")
+            logger.error(f"Failed to delete the object, Reason {traceback.format_exc(chain=False)}")
             return False     
 
+    def delete_thumbnail(self,itemInfo:MetadaDataResponseModel) -> bool:
+        """
+        S3Writer Delete function to delete the thumbnail derivative of an image
+        :parameters
+        -   itemInfo : Metadata item holding the thumbnail key
+        """
+        try:
+            self.client.delete_object(
+                        Bucket=self.bucket_name,
+                        Key=itemInfo.thumbnail
+                    )
+            return True
+        except:
+            logger.error(f"Failed to delete the thumbnail, Reason {traceback.format_exc(chain=False)}")
+            return False
+
+    def delete_objects(self,keys:list) -> dict:
+        """
+        S3Writer Delete function to delete many objects, 1000 keys per DeleteObjects call
+        :parameters
+        -   keys : S3 Keys of the stored objects
+        Returns the error message of every key that could not be deleted
+        """
+        errors = {}
+        for start in range(0,len(keys),S3_DELETE_OBJECTS_SIZE):
+            chunk = keys[start:start + S3_DELETE_OBJECTS_SIZE]
+            try:
+                response = self.client.delete_objects(
+                    Bucket=self.bucket_name,
+                    Delete={"Objects": [{"Key": key} for key in chunk], "Quiet": True}
+                )
+                for error in response.get("Errors",[]):
+                    errors[error.get("Key")] = error.get("Message") or error.get("Code")
+            except:
+                logger.error(f"Failed to delete the objects, Reason {traceback.format_exc(chain=False)}")
+                errors.update({key: "Failed to delete" for key in chunk})
+        return errors
+
+    def delete_prefix(self,prefix:str) -> dict:
+        """
+        S3Writer Delete function to delete every object under a prefix
+        :parameters
+        -   prefix : S3 Key prefix of the stored objects
+        Returns the error message of every key that could not be deleted
+        """
+        try:
+            keys = [content["Key"]
+                    for page in self.client.get_paginator("list_objects_v2").paginate(Bucket=self.bucket_name, Prefix=prefix)
+                    for content in page.get("Contents",[])]
+        except:
+            logger.error(f"Failed to list the objects, Reason {traceback.format_exc(chain=False)}")
+            return {prefix: "Failed to list"}
+        return self.delete_objects(keys)
+
 class DynamoDbWriter():
     def __init__(self):
-        self.dynamodb = boto3.resource("dynamodb")
-        tableName = "imageservice-metadata" # os.environ.get("METADATA_TABLE_NAME","metadatatale")
-        self.table = self.dynamodb.Table(tableName)
+        self.tableName = "imageservice-metadata" # os.environ.get("METADATA_TABLE_NAME","metadatatale")
+
+    @property
+    def table(self):
+        # Resolved per call, the writer may be used from another thread than the one creating it
+        return clients.get_dynamodb_table(self.tableName)
     
-    def write_metadata(self,metadata:MetadataModel):
+    def to_response_model(self,item:dict) -> MetadaDataResponseModel:
+        return MetadaDataResponseModel(
+            userId=item.get("userId"),
+            timestamp=item.get("timestamp"),
+            format=item.get("format"),
+            size=item.get("size"),
+            thumbnail=item.get("thumbnail"),
+            content_hash=item.get("content_hash"),
+            blob=item.get("blob"),
+            byte_size=item.get("byte_size"),
+            variants=sorted(item.get("variants")) if item.get("variants") else None,
+            taken_at=item.get("taken_at"),
+            camera=item.get("camera"))
+
+    def write_metadata(self,metadata:MetadataModel) -> bool:
         try:
-            print(metadata.model_dump())
-            self.table.put_item(Item=metadata.model_dump())
+            logger.debug(metadata.model_dump())
+            # None attributes are left out, a NULL one would break the ADD of the variants
+            self.table.put_item(Item=metadata.model_dump(exclude_none=True))
+            return True
         except:
-            logging.error(f"Failed to write metadata {traceback.format_exc(chain=False)}")
+            logger.error(f"Failed to write metadata {traceback.format_exc(chain=False)}")
+            return False
 
     def get_meta_item(self,userId:str,timestamp:int):
+        from boto3.dynamodb.conditions import Key
         try:
             response = self.table.query(
-            KeyConditionExpression=boto3.dynamodb.conditions.Key("userId").eq(userId) &
-            boto3.dynamodb.conditions.Key("timestamp").eq(timestamp)
+            KeyConditionExpression=Key("userId").eq(userId) &
+            Key("timestamp").eq(timestamp)
         )   
             #TODO: Update the Response
             if response.get("Items") != []:
-                item = response.get("Items")[0]
-                return  MetadaDataResponseModel(
-                    userId=item.get("userId"),
-                    timestamp=item.get("timestamp"),
-                    format=item.get("format"),
-                    size=item.get("size"))
+                return self.to_response_model(response.get("Items")[0])
             else:
                 return []
         except:
-            logging.error(f"Failed to list {traceback.format_exc(chain=False)}")
+            logger.error(f"Failed to list {traceback.format_exc(chain=False)}")
             return None
 
-    def get_meta_items(self,userId:str):
+    def get_meta_page(self,userId:str,limit:int=None,exclusive_start_key:dict=None,newest_first:bool=False) -> ListPageModel:
+        """
+        Query one page of the items of a user
+        :parameters
+        -   limit : Maximum number of items of the page, DynamoDB still stops at 1 MB
+        -   exclusive_start_key : LastEvaluatedKey of the previous page
+        -   newest_first : Order the items by descending timestamp
+        """
+        from boto3.dynamodb.conditions import Key
+        kwargs = {
+            "KeyConditionExpression": Key('userId').eq(userId),
+            "ScanIndexForward": not newest_first
+        }
+        if limit:
+            kwargs["Limit"] = limit
+        if exclusive_start_key:
+            kwargs["ExclusiveStartKey"] = exclusive_start_key
         try:
-            response = self.table.query(
-            KeyConditionExpression=boto3.dynamodb.conditions.Key('userId').eq(userId)
-        )   
-            if response.get("Items") != []:
-                return  [ MetadaDataResponseModel(
-                    userId=item.get("userId"),
-                    timestamp=item.get("timestamp"),
-                    format=item.get("format"),
-                    size=item.get("size")
-                ) for item in response.get("Items") ]
-            else:
-                return []
-            
+            response = self.table.query(**kwargs)
+            return ListPageModel(
+                items=[ self.to_response_model(item) for item in response.get("Items",[]) ],
+                next_cursor=encode_cursor(response.get("LastEvaluatedKey")))
         except:
-            logging.error(f"Failed to list {traceback.format_exc(chain=False)}")
-            return None      
+            logger.error(f"Failed to list {traceback.format_exc(chain=False)}")
+            return None
+
+    def get_meta_items(self,userId:str):
+        """
+        Query all the items of a user, following LastEvaluatedKey across the 1 MB pages
+        """
+        items = []
+        exclusive_start_key = None
+        while True:
+            page = self.get_meta_page(userId=userId,exclusive_start_key=exclusive_start_key)
+            if page is None:
+                return None
+            items.extend(page.items)
+            if page.next_cursor is None:
+                return items
+            exclusive_start_key = decode_cursor(page.next_cursor,userId)
            
-    def delete_meta_item(self,userId:str,timestamp:int):
+    def batch_get_meta_items(self,userId:str,timestamps:list) -> list:
+        """
+        Get the items of a user by timestamp with BatchGetItem, 100 keys per call.
+        Items not found are left out, the order of the result is not the one of the timestamps.
+        """
+        resource = clients.get_dynamodb_resource()
+        # BatchGetItem refuses duplicated keys
+        keys = [{"userId": userId, "timestamp": timestamp} for timestamp in dict.fromkeys(Decimal(str(t)) for t in timestamps)]
+        items = []
+        try:
+            for start in range(0,len(keys),DYNAMODB_BATCH_GET_SIZE):
+                request = {self.tableName: {"Keys": keys[start:start + DYNAMODB_BATCH_GET_SIZE]}}
+                for attempt in range(BATCH_GET_ATTEMPTS):
+                    response = resource.batch_get_item(RequestItems=request)
+                    items.extend(response.get("Responses",{}).get(self.tableName,[]))
+                    request = response.get("UnprocessedKeys")
+                    if not request:
+                        break
+                    time.sleep(0.05 * 2 ** attempt)
+                else:
+                    raise RuntimeError(f"Keys left unprocessed after {BATCH_GET_ATTEMPTS} attempts")
+            return [ self.to_response_model(item) for item in items ]
+        except:
+            logger.error(f"Failed to batch get {traceback.format_exc(chain=False)}")
+            return None
+
+    def batch_delete_meta_items(self,userId:str,timestamps:list) -> bool:
+        """
+        Delete the items of a user by timestamp with BatchWriteItem, the batch writer
+        sends 25 keys per call and resends the unprocessed ones
+        """
+        try:
+            with self.table.batch_writer() as batch:
+                for timestamp in timestamps:
+                    batch.delete_item(Key={"userId": userId, "timestamp": timestamp})
+            return True
+        except:
+            logger.error(f"Failed to batch delete {traceback.format_exc(chain=False)}")
+            return False
+
+    def get_user_ids(self) -> list:
+        """
+        Scan the table for the distinct userIds, used by maintenance commands
+        """
+        try:
+            userIds = set()
+            kwargs = {"ProjectionExpression": "userId"}
+            while True:
+                response = self.table.scan(**kwargs)
+                userIds.update(item.get("userId") for item in response.get("Items",[])
+                               if not item.get("userId").startswith((BLOB_REF_PREFIX,UPLOAD_MARKER_PREFIX)))
+                if "LastEvaluatedKey" not in response:
+                    return sorted(userIds)
+                kwargs["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+        except:
+            logger.error(f"Failed to scan users {traceback.format_exc(chain=False)}")
+            return None
+
+    def set_thumbnail(self,userId:str,timestamp:Decimal,thumbnail:str):
+        try:
+            self.table.update_item(
+                Key={
+                    "userId": userId,
+                    "timestamp": timestamp
+                },
+                UpdateExpression="SET thumbnail = :thumbnail",
+                # The item may be deleted before its thumbnail job runs
+                ConditionExpression="attribute_exists(userId)",
+                ExpressionAttributeValues={":thumbnail": thumbnail}
+            )
+            return True
+        except:
+            logger.error(f"Failed to set thumbnail {traceback.format_exc(chain=False)}")
+            return False
+
+    def set_attributes(self,userId:str,timestamp:Decimal,attributes:dict) -> bool:
+        """
+        Set attributes of an existing item, eg. the ones read by the enrich job
+        """
+        if not attributes:
+            return True
+        try:
+            self.table.update_item(
+                Key={
+                    "userId": userId,
+                    "timestamp": timestamp
+                },
+                UpdateExpression="SET " + ", ".join(f"#{name} = :{name}" for name in attributes),
+                ConditionExpression="attribute_exists(userId)",
+                ExpressionAttributeNames={f"#{name}": name for name in attributes},
+                ExpressionAttributeValues={f":{name}": value for name,value in attributes.items()}
+            )
+            return True
+        except:
+            logger.error(f"Failed to set attributes {traceback.format_exc(chain=False)}")
+            return False
+
+    def add_variant(self,userId:str,timestamp:Decimal,variant:str):
+        """
+        Record the S3 key of a rendered variant on the item, so it is deleted with the image
+        """
+        key = {
+            "userId": userId,
+            "timestamp": timestamp
+        }
+        try:
+            for attempt in range(2):
+                try:
+                    self.table.update_item(
+                        Key=key,
+                        UpdateExpression="ADD variants :variant",
+                        ConditionExpression="attribute_exists(userId)",
+                        ExpressionAttributeValues={":variant": {variant}}
+                    )
+                    return True
+                except Exception as e:
+                    if attempt or clients.error_code(e) != "ValidationException":
+                        raise
+                # Items written before None attributes were left out hold a NULL variants, which ADD refuses
+                try:
+                    self.table.update_item(
+                        Key=key,
+                        UpdateExpression="REMOVE variants",
+                        ConditionExpression="attribute_type(variants, :null)",
+                        ExpressionAttributeValues={":null": "NULL"}
+                    )
+                except Exception as e:
+                    if clients.error_code(e) != "ConditionalCheckFailedException":
+                        raise
+        except:
+            logger.error(f"Failed to add variant {traceback.format_exc(chain=False)}")
+            return False
+
+    def claim_upload(self,userId:str,content_hash:str,timestamp:Decimal,stale:Decimal=None) -> dict:
+        """
+        Record that the item of a user holds a content, with a conditional put so concurrent
+        retries of an upload agree on one item. The claim stays pending until confirm_upload,
+        once the metadata of the item is written.
+        :parameters
+        -   stale : Timestamp of a claim left by an item which no longer exists, replaced
+        Returns the claim holding the content (item_timestamp, pending, claimed_at), with
+        item_timestamp = timestamp when claimed, {} when it was released meanwhile and
+        None when it could not be read
+        """
+        key = {"userId": f"{UPLOAD_MARKER_PREFIX}{userId}#{content_hash}", "timestamp": 0}
+        claim = {"item_timestamp": timestamp, "pending": True, "claimed_at": Decimal(str(time.time()))}
+        condition = "attribute_not_exists(userId)"
+        values = {}
+        if stale is not None:
+            condition += " OR item_timestamp = :stale"
+            values[":stale"] = stale
+        try:
+            self.table.put_item(
+                Item={**key, **claim},
+                ConditionExpression=condition,
+                **({"ExpressionAttributeValues": values} if values else {})
+            )
+            return claim
+        except Exception as e:
+            if clients.error_code(e) != "ConditionalCheckFailedException":
+                logger.error(f"Failed to claim upload {traceback.format_exc(chain=False)}")
+                return None
+        try:
+            return self.table.get_item(Key=key,ConsistentRead=True).get("Item",{})
+        except:
+            logger.error(f"Failed to get upload claim {traceback.format_exc(chain=False)}")
+            return None
+
+    def confirm_upload(self,userId:str,content_hash:str,timestamp:Decimal) -> bool:
+        """
+        Mark the claim of an item as no longer pending, its metadata being written
+        """
+        try:
+            self.table.update_item(
+                Key={"userId": f"{UPLOAD_MARKER_PREFIX}{userId}#{content_hash}", "timestamp": 0},
+                UpdateExpression="REMOVE pending",
+                ConditionExpression="item_timestamp = :timestamp",
+                ExpressionAttributeValues={":timestamp": timestamp}
+            )
+            return True
+        except:
+            logger.error(f"Failed to confirm upload {traceback.format_exc(chain=False)}")
+            return False
+
+    def release_upload(self,userId:str,content_hash:str,timestamp:Decimal) -> bool:
+        """
+        Remove the claim of an item on a content, unless another item holds it meanwhile
+        """
         try:
             self.table.delete_item(
+                Key={"userId": f"{UPLOAD_MARKER_PREFIX}{userId}#{content_hash}", "timestamp": 0},
+                ConditionExpression="attribute_not_exists(userId) OR item_timestamp = :timestamp",
+                ExpressionAttributeValues={":timestamp": timestamp}
+            )
+            return True
+        except Exception as e:
+            if clients.error_code(e) == "ConditionalCheckFailedException":
+                return True
+            logger.error(f"Failed to release upload {traceback.format_exc(chain=False)}")
+            return False
+
+    def add_blob_ref(self,content_hash:str) -> int:
+        """
+        Count one more item referencing the blob of a content, returns the new count.
+        A blob being deleted is waited for up to UPLOAD_CLAIM_WAIT seconds, then referenced
+        again from 1, its count is taken over when its deletion was left for UPLOAD_CLAIM_TTL.
+        """
+        deadline = time.monotonic() + UPLOAD_CLAIM_WAIT
+        while True:
+            try:
+                response = self.table.update_item(
+                    Key={"userId": f"{BLOB_REF_PREFIX}{content_hash}", "timestamp": 0},
+                    UpdateExpression="ADD refs :one REMOVE deleting",
+                    ConditionExpression="attribute_not_exists(deleting) OR deleting < :stale",
+                    ExpressionAttributeValues={":one": 1, ":stale": Decimal(str(time.time() - UPLOAD_CLAIM_TTL))},
+                    ReturnValues="UPDATED_NEW"
+                )
+                return int(response["Attributes"]["refs"])
+            except Exception as e:
+                if clients.error_code(e) != "ConditionalCheckFailedException":
+                    logger.error(f"Failed to reference blob {traceback.format_exc(chain=False)}")
+                    return None
+            if time.monotonic() > deadline:
+                logger.error(f"Blob {content_hash} still being deleted after {UPLOAD_CLAIM_WAIT}s")
+                return None
+            time.sleep(UPLOAD_CLAIM_POLL)
+
+    def remove_blob_ref(self,content_hash:str) -> int:
+        """
+        Count one item less referencing the blob of a content. When it reaches zero the
+        count is marked deleting, so no upload references the blob until drop_blob_ref once
+        its objects are deleted. Returns the new count, 0 meaning the blob must be deleted.
+        """
+        key = {"userId": f"{BLOB_REF_PREFIX}{content_hash}", "timestamp": 0}
+        try:
+            response = self.table.update_item(
+                Key=key,
+                UpdateExpression="ADD refs :minus_one",
+                ConditionExpression="attribute_exists(userId)",
+                ExpressionAttributeValues={":minus_one": -1},
+                ReturnValues="UPDATED_NEW"
+            )
+            refs = int(response["Attributes"]["refs"])
+            if refs > 0:
+                return refs
+            # A concurrent upload may have referenced the blob again in between
+            self.table.update_item(
+                Key=key,
+                UpdateExpression="SET deleting = :now",
+                ConditionExpression="refs <= :zero AND attribute_not_exists(deleting)",
+                ExpressionAttributeValues={":zero": 0, ":now": Decimal(str(time.time()))}
+            )
+            return 0
+        except Exception as e:
+            # No count to decrement, or the blob was referenced again: it is kept
+            if clients.error_code(e) == "ConditionalCheckFailedException":
+                return 1
+            logger.error(f"Failed to release blob {traceback.format_exc(chain=False)}")
+            return None
+
+    def drop_blob_ref(self,content_hash:str) -> bool:
+        """
+        Delete the count of a blob marked deleting by remove_blob_ref, once its objects are deleted
+        """
+        try:
+            self.table.delete_item(
+                Key={"userId": f"{BLOB_REF_PREFIX}{content_hash}", "timestamp": 0},
+                ConditionExpression="attribute_exists(deleting)"
+            )
+            return True
+        except Exception as e:
+            # Taken over by an upload after UPLOAD_CLAIM_TTL
+            if clients.error_code(e) == "ConditionalCheckFailedException":
+                return True
+            logger.error(f"Failed to drop blob reference {traceback.format_exc(chain=False)}")
+            return False
+
+    def delete_meta_item(self,userId:str,timestamp:int):
+        """
+        Delete an item, returns the item deleted, [] when there was none (eg. deleted by a
+        concurrent request) and None when the delete failed
+        """
+        try:
+            response = self.table.delete_item(
                 Key={
                     "userId": userId, 
                     "timestamp": timestamp  
-                }
+                },
+                ConditionExpression="attribute_exists(userId)",
+                ReturnValues="ALL_OLD"
             )
-            
-        except:
-            logging.error(f"Failed to delete item {traceback.format_exc(chain=False)}")
+            return self.to_response_model(response["Attributes"])
+        except Exception as e:
+            if clients.error_code(e) == "ConditionalCheckFailedException":
+                return []
+            logger.error(f"Failed to delete item {traceback.format_exc(chain=False)}")
             return None
 
+def metadata_cache_key(userId:str,timestamp) -> tuple:
+    # Decimal compares and hashes numerically, so 1.10 and 1.1 share the entry
+    return (userId, Decimal(str(timestamp)))
+
+def warm_clients():
+    """
+    Create the shared AWS clients ahead of the first request
+    """
+    S3Writer()
+    DynamoDbWriter().table
+
 class Metadata:
     def __init__(self,userId:str):
         self.userId = userId
         self.writer =  DynamoDbWriter()
 
     def extract_metadata(self,imagefile) -> MetadataModel:
+        return self.new_model(format=imagefile.format,size=imagefile.size)
+
+    def new_model(self,format:str,size:tuple) -> MetadataModel:
         self.model = MetadataModel(
             userId=self.userId,
-            format=imagefile.format,
-            size=imagefile.size,
+            format=format,
+            size=size,
             timestamp=Decimal(str(datetime.datetime.now().timestamp()))
         )
         return self.model
@@ -191,20 +955,289 @@ class Metadata:
         try:
             S3Repo = S3Writer()
             self.model =  self.extract_metadata(imagefile)
-            S3Repo.upload_image(metadata=self.model,body=imagebytes)
-            self.writer.write_metadata(self.model)
-            return self.model
+            self.model.content_hash = content_hash(imagebytes)
+            self.model.byte_size = len(imagebytes)
+            existing = self.store_original(S3Repo,self.model,imagebytes)
+            if existing:
+                return existing
+            return self.commit_image(S3Repo,self.model,imagebytes)
         except:
-            logging.error(f"Failed to write image {traceback.format_exc(chain=False)}")
+            logger.error(f"Failed to write image {traceback.format_exc(chain=False)}")
             return None   
+
+    def store_original(self,S3Repo:S3Writer,model:MetadataModel,body:bytes=None) -> MetadaDataResponseModel:
+        """
+        Store the original of an image once per content, under a key addressed by its hash
+        and shared by reference count between the items holding it. Sets model.blob.
+        Returns the item of the user already holding the same content (a retried upload),
+        in which case nothing is stored and the model must be dropped, else None. When that
+        item is still being stored after UPLOAD_CLAIM_WAIT, the model is returned with its
+        timestamp instead.
+        Raises when the original could not be stored.
+        :parameters
+        -   model : Metadata of the new item, with its content_hash
+        -   body : Content of the original, None when it was streamed to the staging key of the model
+        """
+        staging_key = S3Repo.get_staging_path_from_metadata(itemInfo=model)
+        try:
+            holder = self.claim_original(model)
+            if holder is not None:
+                return holder
+            self.store_blob(S3Repo,model,body,staging_key)
+            return None
+        finally:
+            # Moved to the blob, or not needed
+            if body is None:
+                S3Repo.delete_objects([staging_key])
+
+    def claim_original(self,model:MetadataModel):
+        """
+        Claim the content of the model for its item, returns None when claimed, else the item
+        of the user holding it (see store_original)
+        """
+        deadline = time.monotonic() + UPLOAD_CLAIM_WAIT
+        stale = None
+        while True:
+            claim = self.writer.claim_upload(self.userId,model.content_hash,model.timestamp,stale=stale)
+            if claim is None:
+                raise RuntimeError("Failed to claim the upload")
+            holder = claim.get("item_timestamp")
+            if holder == model.timestamp:
+                return None
+            stale = None
+            if holder is None:
+                # Released by a failed upload meanwhile, claimed again
+                continue
+            if claim.get("pending"):
+                if time.time() - float(claim.get("claimed_at") or 0) > UPLOAD_CLAIM_TTL:
+                    # The upload holding it died before writing its item
+                    stale = holder
+                elif time.monotonic() >= deadline:
+                    return model.model_copy(update={"timestamp": holder, "blob": None})
+                else:
+                    time.sleep(UPLOAD_CLAIM_POLL)
+            else:
+                existing = self.writer.get_meta_item(userId=self.userId,timestamp=holder)
+                if existing:
+                    return existing
+                if existing is None:
+                    raise RuntimeError("Failed to read the item holding the upload")
+                # The item holding the claim was deleted without releasing it
+                stale = holder
+
+    def store_blob(self,S3Repo:S3Writer,model:MetadataModel,body:bytes,staging_key:str):
+        """
+        Reference the blob of a claimed content, storing it when it is the first reference
+        """
+        try:
+            refs = self.writer.add_blob_ref(model.content_hash)
+            if refs is None:
+                raise RuntimeError("Failed to reference the blob")
+            model.blob = S3Repo.get_blob_path(model.content_hash,model.format)
+            try:
+                # The first reference stores the blob, the others only when it went missing
+                if refs == 1 or not S3Repo.object_exists(model.blob):
+                    stored = S3Repo.upload_image(metadata=model,body=body) if body is not None \
+                        else S3Repo.copy_object(staging_key,model.blob)
+                    if not stored:
+                        raise RuntimeError("Failed to store the blob")
+                elif S3Repo.object_exists(S3Repo.get_thumbnail_path_from_metadata(itemInfo=model)):
+                    # Rendered for an earlier item of the same blob
+                    model.thumbnail = S3Repo.get_thumbnail_path_from_metadata(itemInfo=model)
+            except:
+                self.release_blob(S3Repo,model)
+                raise
+        except:
+            model.blob = None
+            self.writer.release_upload(self.userId,model.content_hash,model.timestamp)
+            raise
+
+    def release_original(self,S3Repo:S3Writer,item:MetadaDataResponseModel) -> bool:
+        """
+        Drop the reference of a deleted item to its blob, the blob and its thumbnail are
+        deleted with the last reference
+        """
+        self.writer.release_upload(item.userId,item.content_hash,item.timestamp)
+        return self.release_blob(S3Repo,item)
+
+    def release_blob(self,S3Repo:S3Writer,item:MetadaDataResponseModel) -> bool:
+        """
+        Drop one reference to the blob of an item. With the last one the blob and its thumbnail
+        are deleted before the count, uploads of the content wait for the count to go.
+        """
+        refs = self.writer.remove_blob_ref(item.content_hash)
+        if refs is None:
+            return False
+        if refs == 0:
+            thumbnail = S3Repo.get_thumbnail_path_from_metadata(itemInfo=item)
+            errors = S3Repo.delete_objects([item.blob,thumbnail])
+            thumbnail_cache.invalidate(thumbnail)
+            # Dropped even when the objects are left, the next upload stores them again
+            if not self.writer.drop_blob_ref(item.content_hash) or errors:
+                return False
+        return True
+
+    def commit_image(self,S3Repo:S3Writer,model:MetadataModel,imagesource) -> MetadataModel:
+        """
+        Write the metadata of an image whose original is stored, and queue its post-upload
+        jobs. Until the thumbnail job is done, /list renders the thumbnail from the original,
+        and the image is listed from the manifest once the manifest job is done.
+        :parameters
+        -   imagesource : Content of the original image, or a binary file object holding it
+        """
+        if not self.writer.write_metadata(model):
+            # Drops the blob reference and the claim, and the blob with its last reference
+            self.release_original(S3Repo,model)
+            raise RuntimeError("Failed to write the metadata")
+        if not self.writer.confirm_upload(self.userId,model.content_hash,model.timestamp):
+            logger.error(f"Upload claim of {model.timestamp} left pending, taken over after {UPLOAD_CLAIM_TTL}s")
+        metadata_cache.invalidate(metadata_cache_key(model.userId,model.timestamp))
+        from imageservice import manifest
+        kinds = (["manifest"] if manifest.MANIFEST_ENABLED else []) + \
+                [kind for kind in jobs.UPLOAD_JOBS
+                 if not (kind == "thumbnail" and model.thumbnail) and not (kind == "variants" and not UPLOAD_VARIANTS)]
+        jobs.enqueue(model.userId,model.timestamp,kinds,imagesource)
+        return model
     
+    def write_thumbnail(self,S3Repo:S3Writer,metadata:MetadataModel,imagebytes):
+        """
+        Generate and store the thumbnail derivative, returns its S3 key.
+        A failure only costs the listing fallback, so the upload itself still succeeds.
+        """
+        try:
+            return S3Repo.upload_thumbnail(metadata=metadata,body=processing.run(make_thumbnail,imagebytes))
+        except:
+            logger.error(f"Failed to write thumbnail {traceback.format_exc(chain=False)}")
+            return None
+
+    def backfill_thumbnails(self) -> int:
+        """
+        Generate the thumbnail derivative of every item of the user stored without one
+        """
+        dy = DynamoDbWriter()
+        S3Repo = S3Writer()
+        count = 0
+        for item in dy.get_meta_items(userId=self.userId) or []:
+            if item.thumbnail:
+                continue
+            if self.thumbnail_item(S3Repo,item):
+                count += 1
+        return count
+
+    def thumbnail_item(self,S3Repo:S3Writer,item:MetadaDataResponseModel,imagesource=None) -> bool:
+        """
+        Generate and store the thumbnail of a stored item, and record it on the item
+        :parameters
+        -   imagesource : Content of the original when at hand, else it is read from S3
+        """
+        if imagesource is None:
+            imagesource = S3Repo.get_object_bytes(key=S3Repo.get_file_path_from_metadata(itemInfo=item))
+            if imagesource is None:
+                return False
+        thumbnail = self.write_thumbnail(S3Repo,item,imagesource)
+        if thumbnail and self.writer.set_thumbnail(userId=item.userId,timestamp=item.timestamp,thumbnail=thumbnail):
+            metadata_cache.invalidate(metadata_cache_key(item.userId,item.timestamp))
+            self.update_manifest(lambda manifest: manifest.set_thumbnail(item.timestamp,thumbnail))
+            return True
+        return False
+
+    def update_manifest(self,update):
+        """
+        Apply a change to the manifest of the user, when manifests are enabled
+        """
+        from imageservice import manifest
+        if manifest.MANIFEST_ENABLED:
+            update(manifest.Manifest(self.userId))
+
+    def sync_manifest(self,timestamp:Decimal,imagesource=None):
+        """
+        Manifest job of an upload, adds the item as stored in DynamoDB to the manifest,
+        or removes it when it was deleted meanwhile
+        """
+        from imageservice import manifest
+        if not manifest.MANIFEST_ENABLED:
+            return
+        item = self.writer.get_meta_item(userId=self.userId,timestamp=timestamp)
+        if item is None:
+            raise RuntimeError(f"Failed to read the item {timestamp}")
+        if not manifest.Manifest(self.userId).sync(timestamp,item):
+            raise RuntimeError("Failed to update the manifest")
+
+    def get_job_item(self,timestamp:Decimal) -> MetadaDataResponseModel:
+        # Read from the table, the job may run before the cached metadata was invalidated
+        item = self.writer.get_meta_item(userId=self.userId,timestamp=timestamp)
+        if not item:
+            raise LookupError(f"Item {timestamp} not found")
+        return item
+
+    def process_thumbnail(self,timestamp:Decimal,imagesource=None):
+        """
+        Thumbnail job of an upload, raises when the thumbnail could not be stored
+        """
+        item = self.get_job_item(timestamp)
+        if item.thumbnail:
+            return
+        if not self.thumbnail_item(S3Writer(),item,imagesource):
+            raise RuntimeError("Failed to store the thumbnail")
+
+    def enrich_item(self,timestamp:Decimal,imagesource=None):
+        """
+        Enrich job of an upload, records the capture date and camera read from the EXIF block
+        """
+        item = self.get_job_item(timestamp)
+        if isinstance(imagesource,(bytes,bytearray)):
+            head = bytes(imagesource[:EXIF_HEAD_BYTES])
+        elif imagesource is not None:
+            imagesource.seek(0)
+            head = imagesource.read(EXIF_HEAD_BYTES)
+        else:
+            response = S3Writer().get_image_stream(itemInfo=item,byte_range=f"bytes=0-{EXIF_HEAD_BYTES - 1}")
+            if response is None:
+                raise RuntimeError("Failed to read the image")
+            head = response["Body"].read()
+        if not self.writer.set_attributes(userId=item.userId,timestamp=item.timestamp,attributes=processing.run(read_exif,head)):
+            raise RuntimeError("Failed to record the EXIF metadata")
+        metadata_cache.invalidate(metadata_cache_key(item.userId,item.timestamp))
+
+    def render_upload_variants(self,timestamp:Decimal,imagesource=None):
+        """
+        Variants job of an upload, renders and stores the UPLOAD_VARIANTS ahead of the first /view
+        """
+        item = self.get_job_item(timestamp)
+        for variant in UPLOAD_VARIANTS:
+            if self.get_variant(item,variant) is None:
+                raise RuntimeError(f"Failed to render the variant {variant.name}")
+
     def list_all_items(self):
         return  self.writer.list_items(userId=self.userId)
     
-    def get_item(self,itemInfo:MetadataInputModel):
+    def get_meta_item(self,itemInfo:MetadataInputModel) -> MetadaDataResponseModel:
+        """
+        Get the metadata of an item, served from the metadata cache when present
+        """
+        key = metadata_cache_key(itemInfo.userId,itemInfo.timestamp)
+        metadata = metadata_cache.get(key)
+        if metadata is None:
+            metadata = DynamoDbWriter().get_meta_item(userId=itemInfo.userId,timestamp=itemInfo.timestamp)
+            # Only found items are cached, a missing or failed lookup is retried next time
+            if metadata:
+                metadata_cache.set(key,metadata)
+        return metadata
+
+    def get_item_etag(self,metadata:MetadaDataResponseModel) -> str:
+        """
+        Strong ETag of an item, from the stored content hash or else the S3 ETag,
+        without reading the object body
+        """
+        if metadata.content_hash:
+            return f'"{metadata.content_hash}"'
+        response = S3Writer().head_image(itemInfo=metadata)
+        return response.get("ETag") if response else None
+
+    def get_item(self,itemInfo:MetadataInputModel,metadata:MetadaDataResponseModel=None):
         try:
-            dy = DynamoDbWriter()
-            metadata = dy.get_meta_item(userId=itemInfo.userId,timestamp=itemInfo.timestamp)
+            if metadata is None:
+                metadata = self.get_meta_item(itemInfo)
             if metadata != []:
                 S3Repo = S3Writer()
                 image = S3Repo.get_image(itemInfo=metadata)
@@ -216,49 +1249,336 @@ class Metadata:
                     "timestamp": None,
                     "image" : None }                
         except:
-            logging.error(f"Failed to get item {traceback.format_exc(chain=False)}")
+            logger.error(f"Failed to get item {traceback.format_exc(chain=False)}")
             return None
         
-    def get_items(self) -> dict:
+    def get_item_stream(self,itemInfo:MetadataInputModel,byte_range:str=None,metadata:MetadaDataResponseModel=None) -> dict:
+        """
+        Get the metadata and the unread S3 GetObject response of an item
+        :parameters
+        -   byte_range : HTTP Range header value, eg. bytes=0-1023
+        -   metadata : Metadata of the item when already fetched
+        """
+        if metadata is None:
+            metadata = self.get_meta_item(itemInfo)
+        if not metadata:
+            return None
+        response = S3Writer().get_image_stream(itemInfo=metadata,byte_range=byte_range)
+        if response is None:
+            return None
+        return {
+            "metadata": metadata,
+            "object": response }
+
+    def get_variant(self,metadata:MetadaDataResponseModel,variant:VariantModel) -> bytes:
+        """
+        Get a resized/converted variant of an item. It is rendered from the original on the
+        first request and stored under a deterministic key, later requests read it back.
+        """
+        S3Repo = S3Writer()
+        key = S3Repo.get_variant_path_from_metadata(itemInfo=metadata,variant=variant)
+        body = S3Repo.get_object_if_exists(key)
+        if body is not None:
+            return body
+        imagebytes = S3Repo.get_object_bytes(key=S3Repo.get_file_path_from_metadata(itemInfo=metadata))
+        if imagebytes is None:
+            return None
+        body = processing.run(render_variant,imagebytes,width=variant.width,height=variant.height,
+                              fit=variant.fit,format=variant.format,quality=variant.quality)
+        if S3Repo.put_object(key,body,f"image/{variant.format}") and \
+                DynamoDbWriter().add_variant(userId=metadata.userId,timestamp=metadata.timestamp,variant=key):
+            metadata_cache.invalidate(metadata_cache_key(metadata.userId,metadata.timestamp))
+        return body
+
+    def get_thumbnail(self,S3Repo:S3Writer,item:MetadaDataResponseModel) -> str:
+        """
+        Get the base64 encoded thumbnail of an item, raises when it cannot be produced
+        """
+        key = item.thumbnail or S3Repo.get_file_path_from_metadata(itemInfo=item)
+        thumbnail_base64 = thumbnail_cache.get(key)
+        if thumbnail_base64 is not None:
+            return thumbnail_base64
+        if item.thumbnail:
+            thumbnail_base64 = S3Repo.get_thumbnail(itemInfo=item)
+        else:
+            # Items uploaded before thumbnails were stored, until backfilled
+            image_bytes = S3Repo.get_object_bytes(key=key)
+            if image_bytes is None:
+                raise LookupError("Image not found")
+            thumbnail_bytes = processing.run(make_thumbnail,image_bytes)
+            with span("base64.encode"):
+                thumbnail_base64 = base64.b64encode(thumbnail_bytes).decode('utf-8')
+        if not thumbnail_base64:
+            raise LookupError("Thumbnail not found")
+        thumbnail_cache.set(key,thumbnail_base64)
+        return thumbnail_base64
+
+    def get_thumbnails(self,S3Repo:S3Writer,items:list,item_timeout:float=None) -> list:
+        """
+        Fetch the thumbnails of the items on the shared worker pool.
+        Results keep the order of the items, a failed or timed out item is reported
+        with an error instead of failing the whole listing.
+        :parameters
+        -   item_timeout : Seconds allowed per item, defaults to LIST_ITEM_TIMEOUT
+        """
+        return self.fan_out(lambda item: self.get_thumbnail(S3Repo,item),items,"thumbnail",item_timeout)
+
+    def fan_out(self,func,items:list,field:str,item_timeout:float=None) -> list:
+        """
+        Run func for every item on the shared worker pool, the result is stored as field.
+        Results keep the order of the items, a failed or timed out item is reported
+        with an error instead of failing the whole response.
+        :parameters
+        -   item_timeout : Seconds allowed per item from the moment it starts running,
+                           defaults to LIST_ITEM_TIMEOUT. The whole call waits at most
+                           LIST_REQUEST_TIMEOUT, as items may queue behind other requests.
+        """
+        item_timeout = LIST_ITEM_TIMEOUT if item_timeout is None else item_timeout
+        executor = get_list_executor()
+        started = {}
+        def run(index:int,item):
+            started[index] = time.monotonic()
+            return func(item)
+        # Each item runs in a copy of the request context, so its spans join the request trace
+        futures = [executor.submit(contextvars.copy_context().run,run,index,item) for index,item in enumerate(items)]
+        deadline = time.monotonic() + LIST_REQUEST_TIMEOUT
+        pending = set(futures)
+        while pending:
+            now = time.monotonic()
+            expiries = []
+            for index,future in enumerate(futures):
+                if future in pending and index in started:
+                    if now - started[index] >= item_timeout:
+                        pending.discard(future)
+                    else:
+                        expiries.append(started[index] + item_timeout)
+            if not pending or now >= deadline:
+                break
+            # Wake up on the next completion, the next running item running out of time or the deadline
+            done, _ = concurrent.futures.wait(pending,timeout=max(min(expiries + [deadline]) - now,0.01),
+                                              return_when=concurrent.futures.FIRST_COMPLETED)
+            pending -= done
+
+        results = []
+        for item,future in zip(items,futures):
+            result = {"timestamp" : str(item.timestamp), field: None}
+            if not future.done():
+                future.cancel()
+                result["error"] = "Timed out"
+            elif future.exception() is not None:
+                logger.error(f"Failed to get {field} of {item.timestamp}: {future.exception()!r}")
+                result["error"] = str(future.exception())
+            else:
+                result[field] = future.result()
+            results.append(result)
+        return results
+
+    def get_image(self,S3Repo:S3Writer,item:MetadaDataResponseModel) -> str:
+        image = S3Repo.get_image(itemInfo=item)
+        if not image:
+            raise LookupError("Image not found")
+        return image
+
+    def get_items_batch(self,timestamps:list) -> list:
+        """
+        Get the base64 encoded images of many items, with one BatchGetItem per 100 items
+        and the S3 GETs on the shared worker pool
+        """
         dy = DynamoDbWriter()
         S3Repo = S3Writer()
-        thumbnails = []
+        items = dy.batch_get_meta_items(userId=self.userId,timestamps=timestamps)
+        if items is None:
+            return None
+        found = {item.timestamp: item for item in items}
+        images = iter(self.fan_out(lambda item: self.get_image(S3Repo,item),
+                                   [found[Decimal(str(t))] for t in timestamps if Decimal(str(t)) in found],
+                                   "image"))
+        return [ next(images) if Decimal(str(timestamp)) in found else
+                 {"timestamp": str(timestamp), "image": None, "error": "Not found"}
+                 for timestamp in timestamps ]
+
+    def get_page(self,limit:int=None,cursor:str=None,newest_first:bool=False) -> ListPageModel:
+        """
+        Get the metadata of one page of the items of the user, all items when no limit is given
+        :parameters
+        -   limit : Maximum number of items of the page
+        -   cursor : next_cursor of the previous page
+        -   newest_first : Order the items by descending timestamp
+        """
+        from imageservice import manifest
+        if manifest.MANIFEST_ENABLED:
+            items = manifest.Manifest(self.userId).read()
+            if items is None:
+                return None
+            return manifest.page(items,self.userId,limit=limit,cursor=cursor,newest_first=newest_first)
+        dy = DynamoDbWriter()
+        if limit or cursor:
+            return dy.get_meta_page(userId=self.userId,limit=limit,
+                                    exclusive_start_key=decode_cursor(cursor,self.userId) if cursor else None,
+                                    newest_first=newest_first)
         items = dy.get_meta_items(userId=self.userId)
-        try:
-            if items != []:
-                for item in items:
-                    image = S3Repo.get_image(itemInfo=item)
-                    image_bytes = base64.b64decode(image)
-                    thumb = Image.open(BytesIO(image_bytes))
-                    thumb.thumbnail((150, 150))
-
-                    thumb_io = BytesIO()
-                    thumb.save(thumb_io, format="JPEG")
-                    thumb.seek(0)
-                    thumbnail_base64 = base64.b64encode(thumb_io.getvalue()).decode('utf-8')
-
-                    thumbnails.append({
-                        "timestamp" : str(item.timestamp),
-                        "thumbnail": thumbnail_base64}
-                        )
-                return {"thumbnails": thumbnails}
-            elif items == []:
-                return {"thumbnails": thumbnails}
-            else:
-                None
+        if items is None:
+            return None
+        return ListPageModel(items=items[::-1] if newest_first else items)
 
+    def get_items(self,limit:int=None,cursor:str=None,newest_first:bool=False,page:ListPageModel=None) -> dict:
+        """
+        List the thumbnails of the user, one page at a time when a limit is given
+        :parameters
+        -   limit : Maximum number of items of the page, all items when not given
+        -   cursor : next_cursor of the previous page
+        -   newest_first : Order the items by descending timestamp
+        -   page : Page metadata when already fetched with get_page
+        """
+        S3Repo = S3Writer()
+        if page is None:
+            page = self.get_page(limit=limit,cursor=cursor,newest_first=newest_first)
+        try:
+            if page is None:
+                return None
+            return {"thumbnails": self.get_thumbnails(S3Repo,page.items),
+                    "next_cursor": page.next_cursor}
         except:
-            logging.error(f"Failed to get items {traceback.format_exc(chain=False)}")
+            logger.error(f"Failed to get items {traceback.format_exc(chain=False)}")
             return None
 
+    def get_sprite(self,page:ListPageModel,etag:str,format:str="jpeg") -> dict:
+        """
+        Compose the thumbnails of a /list page into one sprite image, with the box of each
+        thumbnail in it. A complete sprite is stored in S3 under the ETag of the page and
+        served from there until the page changes.
+        :parameters
+        -   page : Page metadata fetched with get_page
+        -   etag : ETag of the page, from list_etag
+        -   format : One of SPRITE_FORMATS
+        """
+        S3Repo = S3Writer()
+        key = S3Repo.get_sprite_path(self.userId,etag,format)
+        body = S3Repo.get_object_if_exists(key)
+        if body is not None:
+            return json.loads(body)
+
+        thumbnails = self.get_thumbnails(S3Repo,page.items)
+        found = [thumbnail for thumbnail in thumbnails if thumbnail["thumbnail"]]
+        with span("base64.decode"):
+            tiles = [base64.b64decode(thumbnail["thumbnail"]) for thumbnail in found]
+        sprite, boxes = processing.run(make_sprite,tiles,format=format)
+        for thumbnail,(x,y,width,height) in zip(found,boxes):
+            thumbnail.update({"x": x, "y": y, "width": width, "height": height})
+        for thumbnail in thumbnails:
+            if not thumbnail["thumbnail"]:
+                thumbnail.setdefault("error","Thumbnail not found")
+        with span("base64.encode"):
+            sprite = base64.b64encode(sprite).decode("utf-8") if sprite else None
+        result = {
+            "sprite": sprite,
+            "format": format,
+            "thumbnails": [{k: v for k,v in thumbnail.items() if k != "thumbnail"} for thumbnail in thumbnails],
+            "next_cursor": page.next_cursor}
+        if len(found) == len(thumbnails):
+            S3Repo.put_object(key,json.dumps(result).encode("utf-8"),"application/json")
+        return result
+
+    def derivative_keys(self,item:MetadaDataResponseModel) -> list:
+        # The thumbnail of a blob is shared, it goes with the blob
+        return ([item.thumbnail] if item.thumbnail and not item.blob else []) + (item.variants or [])
+
+    def delete_sprites(self,S3Repo:S3Writer):
+        """
+        Delete the stored sprites of the user, they hold the thumbnails of the deleted items
+        """
+        errors = S3Repo.delete_prefix(S3Repo.get_sprite_prefix(self.userId))
+        for key,error in errors.items():
+            logger.error(f"Failed to delete the sprite {key}: {error}")
+
+    def delete_items(self,timestamps:list=None) -> list:
+        """
+        Delete many items of the user, or all of them when no timestamps are given.
+        The objects are removed with DeleteObjects (1000 keys per call) and the metadata
+        with BatchWriteItem, an item whose image could not be deleted is kept. Items
+        referencing a blob are deleted one by one with a conditional delete, so only the
+        request deleting an item releases its reference.
+        """
+        dy = DynamoDbWriter()
+        S3Repo = S3Writer()
+        if timestamps is None:
+            items = dy.get_meta_items(userId=self.userId)
+            timestamps = [item.timestamp for item in items or []]
+        else:
+            items = dy.batch_get_meta_items(userId=self.userId,timestamps=timestamps)
+        if items is None:
+            return None
+        found = {item.timestamp: item for item in items}
+
+        # Blobs are released once their items are deleted, the other originals are deleted here
+        originals = {item.timestamp: S3Repo.get_file_path_from_metadata(itemInfo=item) for item in items if not item.blob}
+        errors = S3Repo.delete_objects(list(originals.values()))
+        failed = {timestamp: errors[key] for timestamp,key in originals.items() if key in errors}
+        deleted = [timestamp for timestamp in found if timestamp not in failed]
+        plain = [timestamp for timestamp in deleted if not found[timestamp].blob]
+        if plain and not dy.batch_delete_meta_items(userId=self.userId,timestamps=plain):
+            failed.update({timestamp: "Failed to delete metadata" for timestamp in plain})
+        referencing = [timestamp for timestamp in deleted if found[timestamp].blob]
+        blobs = []
+        olds = get_list_executor().map(lambda timestamp: dy.delete_meta_item(userId=self.userId,timestamp=timestamp),referencing)
+        for timestamp,old in zip(referencing,olds):
+            if old is None:
+                failed[timestamp] = "Failed to delete metadata"
+            elif old:
+                blobs.append(old)
+        deleted = [timestamp for timestamp in deleted if timestamp not in failed]
+        if deleted:
+            self.update_manifest(lambda manifest: manifest.remove(deleted))
+            # Only the derivatives of deleted items, a kept item still lists its thumbnail
+            errors = S3Repo.delete_objects([key for timestamp in deleted for key in self.derivative_keys(found[timestamp])])
+            for key,error in errors.items():
+                logger.error(f"Failed to delete the derivative {key}: {error}")
+            self.delete_sprites(S3Repo)
+            for item,released in zip(blobs,get_list_executor().map(lambda item: self.release_original(S3Repo,item),blobs)):
+                if not released:
+                    logger.error(f"Failed to release the blob of {item.timestamp}")
+        for timestamp,item in found.items():
+            metadata_cache.invalidate(metadata_cache_key(self.userId,timestamp))
+            thumbnail_cache.invalidate(item.thumbnail or S3Repo.get_file_path_from_metadata(itemInfo=item))
+
+        results = []
+        for timestamp in timestamps:
+            timestamp = Decimal(str(timestamp))
+            result = {"timestamp": str(timestamp), "deleted": False}
+            if timestamp not in found:
+                result["error"] = "Not found"
+            elif timestamp in failed:
+                result["error"] = failed[timestamp]
+            else:
+                result["deleted"] = True
+            results.append(result)
+        return results
+
     def delete_item(self,itemInfo:MetadataInputModel):
         try:
             dy = DynamoDbWriter()
+            # Read from the table, a cached item may be deleted already
             metadata = dy.get_meta_item(userId=itemInfo.userId,timestamp=itemInfo.timestamp)
+            if not metadata:
+                return None
             S3Repo = S3Writer()
-            image = S3Repo.delete_image(itemInfo=metadata)
-            dy.delete_meta_item(userId=itemInfo.userId,timestamp=itemInfo.timestamp)
+            if not metadata.blob:
+                image = S3Repo.delete_image(itemInfo=metadata)
+                if metadata.thumbnail:
+                    S3Repo.delete_thumbnail(itemInfo=metadata)
+            if metadata.variants:
+                S3Repo.delete_objects(metadata.variants)
+            old = dy.delete_meta_item(userId=itemInfo.userId,timestamp=itemInfo.timestamp)
+            if old is None:
+                return None
+            self.update_manifest(lambda manifest: manifest.remove([itemInfo.timestamp]))
+            self.delete_sprites(S3Repo)
+            # Only the request deleting the item drops its reference
+            if old and old.blob:
+                self.release_original(S3Repo,old)
+            metadata_cache.invalidate(metadata_cache_key(itemInfo.userId,itemInfo.timestamp))
+            thumbnail_cache.invalidate(metadata.thumbnail or S3Repo.get_file_path_from_metadata(itemInfo=metadata))
             return True
         except:
-            logging.error(f"Failed to delete items {traceback.format_exc(chain=False)}")
+            logger.error(f"Failed to delete items {traceback.format_exc(chain=False)}")
             return None
@@ -5,6 +5,7 @@ To run the test, start the uvicorn server and run the below command
 """
 
 
+import base64
 import json
 import requests
 import logging
@@ -26,6 +27,46 @@ def test_upload_image():
     response = requests.post(url, headers=headers, data=message)
     assert response.status_code == 200
 
+def test_upload_image_binary():
+
+    url = 'http://localhost:8000/upload?userId=3241'
+    image_bytes = base64.b64decode(json.loads(message))
+    response = requests.post(url, headers={'Content-Type': 'application/octet-stream'}, data=image_bytes)
+    assert response.status_code == 200
+
+    response = requests.post(url, files={'image': ('image.jpeg', image_bytes, 'image/jpeg')})
+    assert response.status_code == 200
+
+    response = requests.post(url, headers={'Content-Type': 'application/octet-stream'}, data=b'not an image')
+    assert response.status_code == 400
+
+def test_upload_image_retried():
+
+    url = 'http://localhost:8000/upload?userId=3241'
+    headers = {
+        'accept': 'application/json',
+        'Content-Type': 'application/json',
+    }
+    requests.post(url, headers=headers, data=message)
+    count = len(json.loads(test_list_images()).get("thumbnails"))
+    # The same content uploaded again by the same user is stored once
+    response = requests.post(url, headers=headers, data=message)
+    assert response.status_code == 200
+    assert len(json.loads(test_list_images()).get("thumbnails")) == count
+
+def test_upload_image_jobs():
+
+    url = 'http://localhost:8000/upload?userId=3241'
+    image_bytes = base64.b64decode(json.loads(message))
+    response = requests.post(url, headers={'Content-Type': 'application/octet-stream'}, data=image_bytes)
+    assert response.status_code == 200
+    timestamp = response.headers.get("X-Image-Timestamp")
+    assert timestamp
+
+    response = requests.get('http://localhost:8000/jobs', params={"userId": "3241", "timestamp": timestamp})
+    assert response.status_code == 200
+    assert all(job.get("status") in ("queued", "running", "done") for job in response.json().get("jobs"))
+
 def test_list_images():
 
     url = 'http://localhost:8000/list?userId=3241'
@@ -38,6 +79,37 @@ def test_list_images():
     assert len(response.content) != 0
     return response.content
 
+def test_list_images_paginated():
+
+    url = 'http://localhost:8000/list'
+    headers = {
+        'accept': 'application/json',
+        'Content-Type': 'application/json',
+    }
+    params = {"userId": "3241", "limit": 1, "order": "desc"}
+    response = requests.get(url, headers=headers, params=params)
+    assert response.status_code == 200
+    content = response.json()
+    assert len(content.get("thumbnails")) <= 1
+    if content.get("next_cursor"):
+        response = requests.get(url, headers=headers, params={**params, "cursor": content.get("next_cursor")})
+        assert response.status_code == 200
+
+def test_list_images_invalid_cursor():
+
+    url = 'http://localhost:8000/list'
+    response = requests.get(url, params={"userId": "3241", "limit": 1, "cursor": "invalid"})
+    assert response.status_code == 400
+
+def test_list_images_sprite():
+
+    url = 'http://localhost:8000/list'
+    response = requests.get(url, params={"userId": "3241", "limit": 4, "mode": "sprite", "format": "webp"})
+    assert response.status_code == 200
+    content = response.json()
+    assert content.get("sprite") and content.get("format") == "webp"
+    assert all("x" in thumbnail and "width" in thumbnail for thumbnail in content.get("thumbnails"))
+
 def test_view_image():
     content = json.loads(test_list_images())
     url = 'http://localhost:8000/list'
@@ -53,6 +125,59 @@ def test_view_image():
         })
         assert response.status_code == 200
 
+def test_view_image_binary():
+    content = json.loads(test_list_images())
+    url = 'http://localhost:8000/view'
+    for time in content.get("thumbnails",[]):
+        params = {
+            "timestamp" :time.get("timestamp"),
+            "userId": "3241",
+            "mode": "binary"
+        }
+        response = requests.get(url, params=params)
+        assert response.status_code == 200
+        assert response.headers.get("content-type").startswith("image/")
+        assert int(response.headers.get("content-length")) == len(response.content)
+
+        response = requests.get(url, params=params, headers={"Range": "bytes=0-9"})
+        assert response.status_code == 206
+        assert len(response.content) == 10
+
+def test_view_image_not_modified():
+    content = json.loads(test_list_images())
+    url = 'http://localhost:8000/view'
+    for time in content.get("thumbnails",[]):
+        params = {
+            "timestamp" :time.get("timestamp"),
+            "userId": "3241"
+        }
+        response = requests.get(url, params=params)
+        assert response.status_code == 200
+        etag = response.headers.get("etag")
+        assert etag
+
+        response = requests.get(url, params=params, headers={"If-None-Match": etag})
+        assert response.status_code == 304
+        assert len(response.content) == 0
+
+def test_view_image_variant():
+    content = json.loads(test_list_images())
+    url = 'http://localhost:8000/view'
+    for time in content.get("thumbnails",[]):
+        params = {
+            "timestamp" :time.get("timestamp"),
+            "userId": "3241",
+            "width": 50
+        }
+        response = requests.get(url, params=params, headers={"Accept": "image/webp,image/*"})
+        assert response.status_code == 200
+        assert response.headers.get("content-type") == "image/webp"
+        assert response.headers.get("vary") == "Accept"
+
+        response = requests.get(url, params={**params, "format": "png"})
+        assert response.status_code == 200
+        assert response.headers.get("content-type") == "image/png"
+
 def test_delete_image():
     content = json.loads(test_list_images())
     url = 'http://localhost:8000/delete'
@@ -67,3 +192,33 @@ def test_delete_image():
             "userId": "3241"
         })
         assert response.status_code == 200
+
+def test_view_images_batch():
+    test_upload_image()
+    content = json.loads(test_list_images())
+    timestamps = [time.get("timestamp") for time in content.get("thumbnails",[])]
+    response = requests.post('http://localhost:8000/view/batch', params={"userId": "3241"},
+                             json={"timestamps": timestamps + ["1"]})
+    assert response.status_code == 200
+    images = response.json().get("images")
+    assert [image.get("timestamp") for image in images[:-1]] == timestamps
+    assert all(image.get("image") for image in images[:-1])
+    assert images[-1].get("error") == "Not found"
+
+def test_delete_images_batch():
+    test_upload_image()
+    response = requests.post('http://localhost:8000/delete/batch', params={"userId": "3241"},
+                             json={"all": True})
+    assert response.status_code == 200
+    assert all(result.get("deleted") for result in response.json().get("results"))
+
+    response = requests.get('http://localhost:8000/list', params={"userId": "3241"})
+    assert response.status_code == 404
+
+def test_list_images_rate_limited():
+
+    url = 'http://localhost:8000/list'
+    responses = [requests.get(url, params={"userId": "rate-limited-user"}) for _ in range(40)]
+    limited = [response for response in responses if response.status_code == 429]
+    assert limited
+    assert limited[0].headers.get("Retry-After")
@@ -0,0 +1,63 @@
+""""
+Tests of the leases of the SQLite job store, they do not need the server
+- PYTHONPATH=src pytest tests/test_jobs.py
+"""
+
+
+import time
+import uuid
+from decimal import Decimal
+
+from imageservice import jobs
+
+userId="3241"
+timestamp=Decimal("1700000000.000001")
+
+def make_job(kind:str="thumbnail",status:str=jobs.QUEUED) -> jobs.JobModel:
+    return jobs.JobModel(id=uuid.uuid4().hex, kind=kind, userId=userId, timestamp=timestamp,
+                         status=status, created=jobs.now(), updated=jobs.now())
+
+def test_lease_take_over(tmp_path):
+
+    path = str(tmp_path / "jobs.sqlite3")
+    first = jobs.SqliteJobStore(path,owner="first",lease=1)
+    second = jobs.SqliteJobStore(path,owner="second",lease=1)
+    running, queued, done = make_job("thumbnail",jobs.RUNNING), make_job("enrich"), make_job("variants",jobs.DONE)
+    for job in (running, queued, done):
+        first.add(job)
+
+    # Leased by the first process, which renews its leases while running
+    assert second.take_over() == []
+    time.sleep(0.6)
+    assert first.renew() == 2
+    time.sleep(0.6)
+    assert second.take_over() == []
+
+    # The first process stopped, its queued and running jobs go to the second once the lease expired
+    time.sleep(0.6)
+    taken = second.take_over()
+    assert sorted(job.id for job in taken) == sorted((running.id, queued.id))
+    assert first.renew() == 0
+    assert second.take_over() == []
+    assert second.renew() == 2
+
+    # The first process is left behind, its updates of the jobs taken over are ignored
+    running.status, running.error = jobs.FAILED, "stale"
+    first.update(running)
+    job, = [job for job in second.get_for_item(userId,timestamp) if job.id == running.id]
+    assert job.status == jobs.RUNNING and job.error is None
+    job.status, job.attempts = jobs.DONE, 1
+    second.update(job)
+    assert second.counts() == {jobs.DONE: 2, jobs.QUEUED: 1}
+
+def test_take_over_jobs_without_lease(tmp_path):
+
+    path = str(tmp_path / "jobs.sqlite3")
+    first = jobs.SqliteJobStore(path,owner="first")
+    job = make_job()
+    first.add(job)
+    with first.connect() as db:
+        # As in files created before the leases
+        db.execute("UPDATE jobs SET owner=NULL, lease=NULL")
+    taken = jobs.SqliteJobStore(path,owner="second").take_over()
+    assert [taken_job.id for taken_job in taken] == [job.id]
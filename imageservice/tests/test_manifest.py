@@ -0,0 +1,69 @@
+""""
+Tests of the manifest encoding and of its pages, they do not need the server
+- PYTHONPATH=src pytest tests/test_manifest.py
+"""
+
+
+import hashlib
+import os
+from decimal import Decimal
+
+# Creating the S3 client deriving the keys needs a region, no request is made
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+
+from imageservice import manifest, utils
+
+userId="3241"
+
+def make_items():
+    S3Repo = utils.S3Writer()
+    items = []
+    for index in range(5):
+        content_hash = hashlib.sha256(str(index).encode("utf-8")).hexdigest()
+        item = utils.MetadaDataResponseModel(userId=userId, timestamp=Decimal(f"1700000000.{index:06d}"),
+                                             format="JPEG", size=(640 + index, 480), byte_size=1000 + index,
+                                             content_hash=content_hash)
+        if index != 1:
+            item.blob = S3Repo.get_blob_path(content_hash,item.format)
+        if index % 2 == 0:
+            item.thumbnail = S3Repo.get_thumbnail_path_from_metadata(itemInfo=item)
+        items.append(item)
+    # Stored before deduplication, without hash, blob or thumbnail
+    items.append(utils.MetadaDataResponseModel(userId=userId, timestamp=Decimal("1700000001.5"), format="PNG", size=(1, 2)))
+    return items
+
+def test_manifest_round_trip():
+
+    items = make_items()
+    body = manifest.encode(items)
+    decoded = manifest.decode(userId,body)
+    assert [item.model_dump() for item in decoded] == [item.model_dump() for item in items]
+    # The hashes are stored raw, the keys are not stored
+    assert len(body) == manifest.HEADER.size + manifest.RECORD.size * len(items) + len("\0".join(
+        f"{item.timestamp}\0{item.format}" for item in items))
+
+    assert manifest.decode(userId,manifest.encode([])) == []
+    assert manifest.decode(userId,manifest.dirty_marker()) is None
+    assert manifest.decode(userId,b"IMFT") is None
+
+def test_manifest_page_cursors():
+
+    items = manifest.decode(userId,manifest.encode(make_items()))
+    timestamps = [item.timestamp for item in items]
+
+    for newest_first in (False, True):
+        expected = timestamps[::-1] if newest_first else timestamps
+        seen, cursor = [], None
+        while True:
+            page = manifest.page(items,userId,limit=4,cursor=cursor,newest_first=newest_first)
+            seen += [item.timestamp for item in page.items]
+            cursor = page.next_cursor
+            if cursor is None:
+                break
+            assert utils.decode_cursor(cursor,userId)["timestamp"] == page.items[-1].timestamp
+        assert seen == expected
+
+    page = manifest.page(items,userId)
+    assert [item.timestamp for item in page.items] == timestamps and page.next_cursor is None
+    page = manifest.page(items,userId,limit=len(items))
+    assert page.next_cursor is None
@@ -0,0 +1,151 @@
+""""
+Tests of the admission control, they do not need the server
+- PYTHONPATH=src pytest tests/test_ratelimit.py
+"""
+
+
+import asyncio
+import os
+import pytest
+from starlette.requests import Request
+from starlette.responses import JSONResponse
+
+# Creating the S3 client of imageservice.aio needs a region, no request is made
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+
+from imageservice import aio, ratelimit
+from imageservice.ratelimit import LimitModel, RateLimiter
+
+def make_request(path:str="/list",query:str="userId=3241",headers:list=None) -> Request:
+    return Request({"type": "http", "method": "GET", "path": path, "query_string": query.encode("utf-8"),
+                    "headers": headers or []})
+
+def test_refill():
+
+    # A full bucket gives a token, an empty one tells how long to wait for the next
+    assert ratelimit.refill(5,0,1,5,0) == (4,0)
+    assert ratelimit.refill(0,0,2,5,0) == (0,0.5)
+    assert ratelimit.refill(0.5,10,1,5,10) == (0.5,0.5)
+    # Refilled at rate up to burst
+    assert ratelimit.refill(0,0,2,5,1) == (1,0)
+    assert ratelimit.refill(0,0,2,5,100) == (4,0)
+
+def test_memory_store():
+
+    store = ratelimit.MemoryRateLimitStore(max_keys=2)
+    assert store.take("a",1,2) == 0
+    assert store.take("a",1,2) == 0
+    assert store.take("a",1,2) == pytest.approx(1,abs=0.1)
+    store.take("b",1,2)
+    store.take("c",1,2)
+    # The least recently used bucket was dropped, it starts full again
+    assert list(store.buckets) == ["b","c"]
+    assert store.take("a",1,2) == 0
+
+def test_retry_after():
+
+    limiter = RateLimiter(ratelimit.MemoryRateLimitStore(),{},{})
+    for retry_after, header in ((0.2,"1"), (1,"1"), (1.5,"2"), (0,"1")):
+        response = limiter.reject("user_rate",retry_after,429)
+        assert response.status_code == 429 and response.headers["Retry-After"] == header
+    assert limiter.stats()["rejected"] == {"user_rate": 4}
+
+def test_rate_limits():
+
+    limiter = RateLimiter(ratelimit.MemoryRateLimitStore(),{"/list": LimitModel(rate=1,burst=1)},
+                          {"/list": LimitModel(rate=0.5,burst=2)})
+    async def call_next(request):
+        return JSONResponse({})
+    async def send(query:str):
+        return await limiter.middleware(make_request(query=query),call_next)
+
+    assert asyncio.run(send("userId=1")).status_code == 200
+    response = asyncio.run(send("userId=1"))
+    assert response.status_code == 429 and response.headers["Retry-After"] == "1"
+    # Another user has its own bucket, the global one is empty after it
+    assert asyncio.run(send("userId=2")).status_code == 200
+    response = asyncio.run(send("userId=3"))
+    assert response.status_code == 503 and response.headers["Retry-After"] == "2"
+    # Routes without limits are not counted
+    asyncio.run(limiter.middleware(make_request("/jobs"),call_next))
+    assert limiter.stats()["admitted"] == 2
+
+def test_enter_leave():
+
+    limiter = RateLimiter(ratelimit.MemoryRateLimitStore(),{"/list": LimitModel(concurrency=2)},
+                          {"/list": LimitModel(concurrency=3)})
+    assert limiter.enter("/list","1") is None
+    assert limiter.enter("/list","1") is None
+    assert limiter.enter("/list","1") == "user_concurrency"
+    assert limiter.enter("/list","2") is None
+    assert limiter.enter("/list","3") == "global_concurrency"
+    assert limiter.stats()["in_progress"] == 3
+    limiter.leave("/list","1")
+    assert limiter.enter("/list","3") is None
+    for user in ("1","2","3"):
+        limiter.leave("/list",user)
+    assert limiter.in_progress == {} and limiter.stats()["admitted"] == 4
+
+def test_admit_outside_of_a_request():
+
+    # Nothing to count for the requests let in under the limits, or not limited
+    assert ratelimit.admit(joining=False) is None
+    assert ratelimit.admit(joining=True) is None
+
+def test_concurrency_joined():
+
+    limiter = RateLimiter(ratelimit.MemoryRateLimitStore(),{"/list": LimitModel(concurrency=1)},{})
+
+    async def scenario():
+        release = asyncio.Event()
+        async def read(key:str):
+            await release.wait()
+            return key
+
+        async def route(request):
+            # As the routes, reads through aio.coalesce and answers a ConcurrencyLimited with its response
+            try:
+                key = ("list", request.query_params["userId"], request.query_params.get("key", "a"))
+                return JSONResponse({"key": await aio.coalesce(key,read,key[2])})
+            except ratelimit.ConcurrencyLimited as e:
+                return e.response
+
+        async def send(query:str="userId=1",headers:list=None):
+            return await limiter.middleware(make_request(query=query,headers=headers),route)
+
+        leader = asyncio.create_task(send())
+        await asyncio.sleep(0)
+        assert limiter.in_progress["/list|1"] == 1
+        # Over the limit, an identical read joins the read in progress without being counted
+        joined = asyncio.create_task(send())
+        await asyncio.sleep(0)
+        assert limiter.in_progress["/list|1"] == 1 and limiter.joined == 1
+        # Over the limit, another read would run itself
+        limited = await send("userId=1&key=b")
+        assert limited.status_code == 429 and limited.headers["Retry-After"] == "1"
+        # Streamed and ranged reads do not go through aio.coalesce, rejected right away
+        assert (await send("userId=1&mode=binary")).status_code == 429
+        assert (await send(headers=[(b"range", b"bytes=0-1")])).status_code == 429
+        release.set()
+        assert (await leader).status_code == 200 and (await joined).status_code == 200
+        assert limiter.in_progress == {}
+
+        # Let in over the limit, but the read in progress ended before it read, so counted for its own
+        release.clear()
+        leader = asyncio.create_task(send())
+        await asyncio.sleep(0)
+        async def late(request):
+            await leader
+            assert limiter.in_progress == {}
+            return await route(request)
+        late_request = asyncio.create_task(limiter.middleware(make_request(query="userId=1"),late))
+        await asyncio.sleep(0)
+        release.set()
+        response = await late_request
+        assert response.status_code == 200
+        assert limiter.in_progress == {}
+
+    asyncio.run(scenario())
+    stats = limiter.stats()
+    assert stats["joined"] == 1 and stats["admitted"] == 3
+    assert stats["rejected"] == {"user_concurrency": 3}